@@ -0,0 +1,343 @@
+"""
+コーパスの索引（文書ごとの単語の出現回数）。
+
+コーパスを一度だけ形態素解析しておき、日付・番組・話者などで絞り込んだ文書の
+ワードクラウドを解析し直さずに作る（選んだ行の出現回数をNumPyで足し合わせるだけ）。
+
+使い方:
+    python Streamlit/corpus_index.py build 入力 索引ディレクトリ --settings settings.json
+    python Streamlit/corpus_index.py cloud 索引ディレクトリ --where program=ニュース --out news.png
+
+入力:
+    - ディレクトリ: 中の .txt / .csv をそれぞれ1文書とする（id は相対パス）
+    - マニフェスト（.jsonl）: 1行に1文書 {"id": "...", "text": "..." または "input": "a.txt", ...}
+      （id・text・input 以外の項目はメタデータとして --where の絞り込みに使う）
+    - マニフェスト（それ以外）: 1行に1つ入力ファイルのパス
+
+索引の形式（ディレクトリ）:
+    meta.json        形式のバージョン・解析の条件（品詞・除外語・優先名詞・正規化・形態素解析エンジン）・文書数・語彙数
+    vocab.json       語彙（列番号の順の単語のリスト。全文書で共有）
+    documents.jsonl  行番号の順の文書の id とメタデータ
+    indptr.npy / indices.npy / counts.npy
+                     文書×語彙の出現回数（CSR形式）。np.load(mmap_mode="r") で読むので、
+                     索引全体をメモリに載せない
+出現回数は大文字小文字・複数形をまとめる前の値で持ち、選んだ文書の合計に fuse_word_counts() を
+適用する（まとめた後の値は文書をまたいで足し合わせられないため）。
+"""
+import io
+import os
+import sys
+import json
+import shutil
+import argparse
+from array import array
+from collections import Counter
+
+import numpy as np
+
+from instrumentation import span
+from morphology import (
+    fuse_word_counts,
+    get_default_japanese_stopwords,
+    iter_csv_chunks,
+    iter_raw_counts,
+    iter_raw_counts_parallel,
+    iter_text_chunks,
+    open_text_stream,
+    parallel_enabled,
+    resolve_backend_name,
+)
+from wordcloud_settings import (
+    DEFAULT_FONT_PATH,
+    IMAGE_FORMATS,
+    INPUT_EXTENSIONS,
+    load_settings,
+    normalize_settings,
+    split_comma_list,
+)
+
+INDEX_FORMAT_VERSION = 1
+
+
+# =========================================================
+# 入力の列挙
+# =========================================================
+def iter_documents(input_path):
+    """
+    (id, メタデータ, テキストまたはファイルパス, ファイルかどうか) を列挙する。
+    """
+    if os.path.isdir(input_path):
+        for root, dirs, files in os.walk(input_path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(INPUT_EXTENSIONS):
+                    path = os.path.join(root, name)
+                    yield os.path.relpath(path, input_path), {}, path, True
+        return
+
+    base_dir = os.path.dirname(os.path.abspath(input_path))
+    with open(input_path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if not input_path.lower().endswith(".jsonl"):
+                yield line, {}, os.path.join(base_dir, line), True
+                continue
+            item = json.loads(line)
+            metadata = {k: v for k, v in item.items() if k not in ("id", "text", "input")}
+            if "text" in item:
+                yield str(item.get("id", "")), metadata, item["text"], False
+            else:
+                yield str(item.get("id", item["input"])), metadata, os.path.join(base_dir, item["input"]), True
+
+
+def iter_document_chunks(source, is_file):
+    """
+    1文書を解析用のチャンクに分けて返す（空の文書でも空文字列を1つ返す）。
+    """
+    empty = True
+    if is_file:
+        with open(source, "rb") as binary, open_text_stream(binary) as stream:
+            is_csv = source.lower().endswith(".csv")
+            for chunk in iter_csv_chunks(stream) if is_csv else iter_text_chunks(stream):
+                empty = False
+                yield chunk
+    else:
+        for chunk in iter_text_chunks(io.StringIO(source)):
+            empty = False
+            yield chunk
+    if empty:
+        yield ""
+
+
+# =========================================================
+# 索引の作成
+# =========================================================
+def _iter_raw_counts(keyed_chunks, selected_pos, exclude_words, priority_nouns, normalize):
+    if parallel_enabled():
+        yield from iter_raw_counts_parallel(keyed_chunks, selected_pos, exclude_words, priority_nouns, normalize)
+        return
+    yield from iter_raw_counts(keyed_chunks, selected_pos, exclude_words, priority_nouns, normalize)
+
+
+def build_index(documents, index_dir, selected_pos, exclude_words=None, priority_nouns=None, normalize=False):
+    """
+    documents（iter_documents() の形式）を解析して index_dir に索引を書き出す。戻り値は文書数。
+    既に索引があれば書き終わってから置き換える。
+    """
+    exclude_words = list(exclude_words or [])
+    priority_nouns = list(priority_nouns or [])
+    doc_meta = []
+
+    def keyed_chunks():
+        for doc_no, (doc_id, metadata, source, is_file) in enumerate(documents):
+            doc_meta.append({"id": doc_id, **metadata})
+            for chunk in iter_document_chunks(source, is_file):
+                yield doc_no, chunk
+
+    vocab = {}
+    indptr = array("q", [0])
+    indices = array("i")
+    counts = array("i")
+
+    def flush(doc_counts):
+        term_ids = sorted((vocab.setdefault(word, len(vocab)), n) for word, n in doc_counts.items())
+        indices.extend(t for t, _ in term_ids)
+        counts.extend(n for _, n in term_ids)
+        indptr.append(len(indices))
+
+    with span("index", attrs={"path": index_dir}) as s:
+        current, doc_counts = 0, Counter()
+        raw_counts = _iter_raw_counts(keyed_chunks(), selected_pos, exclude_words, priority_nouns, normalize)
+        for doc_no, raw in raw_counts:
+            if doc_no != current:
+                flush(doc_counts)
+                current, doc_counts = doc_no, Counter()
+            doc_counts.update(raw)
+        if doc_meta:
+            flush(doc_counts)
+        s.counts.update(documents=len(doc_meta), terms=len(vocab), nonzero=len(indices))
+
+        tmp_dir = f"{index_dir.rstrip(os.sep)}.tmp{os.getpid()}"
+        os.makedirs(tmp_dir)
+        meta = {
+            "version": INDEX_FORMAT_VERSION,
+            "selected_pos": list(selected_pos),
+            "exclude_words": exclude_words,
+            "priority_nouns": priority_nouns,
+            "normalize": bool(normalize),
+            "tokenizer": resolve_backend_name(),
+            "documents": len(doc_meta),
+            "terms": len(vocab),
+        }
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=1)
+        with open(os.path.join(tmp_dir, "vocab.json"), "w", encoding="utf-8") as f:
+            # vocab は出現順に番号を振っているので、そのまま並べれば列番号の順になる
+            json.dump(list(vocab), f, ensure_ascii=False)
+        with open(os.path.join(tmp_dir, "documents.jsonl"), "w", encoding="utf-8") as f:
+            for doc in doc_meta:
+                f.write(json.dumps(doc, ensure_ascii=False) + "\n")
+        np.save(os.path.join(tmp_dir, "indptr.npy"), np.frombuffer(indptr, dtype=np.int64))
+        np.save(os.path.join(tmp_dir, "indices.npy"), np.frombuffer(indices, dtype=np.int32))
+        np.save(os.path.join(tmp_dir, "counts.npy"), np.frombuffer(counts, dtype=np.int32))
+
+        if os.path.exists(index_dir):
+            old_dir = f"{index_dir.rstrip(os.sep)}.old{os.getpid()}"
+            os.replace(index_dir, old_dir)
+            os.replace(tmp_dir, index_dir)
+            shutil.rmtree(old_dir)
+        else:
+            os.replace(tmp_dir, index_dir)
+    return len(doc_meta)
+
+
+# =========================================================
+# 索引の読み込みと絞り込み
+# =========================================================
+class CorpusIndex:
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != INDEX_FORMAT_VERSION:
+            raise ValueError(f"索引の形式が違います（version={self.meta.get('version')}）: {index_dir}")
+        with open(os.path.join(index_dir, "vocab.json"), encoding="utf-8") as f:
+            self.vocab = json.load(f)
+        with open(os.path.join(index_dir, "documents.jsonl"), encoding="utf-8") as f:
+            self.documents = [json.loads(line) for line in f]
+        self.indptr = np.load(os.path.join(index_dir, "indptr.npy"), mmap_mode="r")
+        self.indices = np.load(os.path.join(index_dir, "indices.npy"), mmap_mode="r")
+        self.counts = np.load(os.path.join(index_dir, "counts.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.documents)
+
+    def select(self, where=None, ids=None):
+        """
+        条件に合う文書の行番号を返す。where は {項目: 値 または 値のリスト}（すべて満たすもの）。
+        値は文字列として比べる。
+        """
+        wanted = {
+            key: {str(v) for v in (values if isinstance(values, (list, tuple, set)) else [values])}
+            for key, values in (where or {}).items()
+        }
+        ids = set(ids) if ids is not None else None
+        rows = [
+            row for row, doc in enumerate(self.documents)
+            if (ids is None or doc["id"] in ids)
+            and all(str(doc.get(key)) in values for key, values in wanted.items())
+        ]
+        return np.array(rows, dtype=np.int64)
+
+    def raw_counts(self, rows=None):
+        """
+        選んだ文書の出現回数の合計（語彙の列番号の順のint64配列）。rows が None なら全文書。
+        """
+        if rows is None:
+            indices, counts = self.indices, self.counts
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+            starts = self.indptr[rows]
+            lengths = self.indptr[rows + 1] - starts
+            # 選んだ行の範囲をつないだ添字（各範囲の先頭からの連番を np.repeat で作る）
+            offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+            indices, counts = self.indices[offsets], self.counts[offsets]
+        totals = np.bincount(indices, weights=counts, minlength=len(self.vocab))
+        return totals.astype(np.int64)
+
+    def frequencies(self, rows=None):
+        """
+        選んだ文書の 単語→出現回数（tokenize_japanese() と同じ規則でまとめたもの）。
+        """
+        with span("subset", documents=len(self) if rows is None else len(rows)) as s:
+            totals = self.raw_counts(rows)
+            nonzero = np.flatnonzero(totals)
+            raw = dict(zip((self.vocab[i] for i in nonzero), totals[nonzero].tolist()))
+            frequencies = fuse_word_counts(raw)
+            s.counts["unique_words"] = len(frequencies)
+        return frequencies
+
+
+# =========================================================
+# main
+# =========================================================
+def parse_where(items):
+    """
+    ["program=ニュース", "speaker=A,B"] → {"program": ["ニュース"], "speaker": ["A", "B"]}
+    """
+    where = {}
+    for item in items or []:
+        key, sep, value = item.partition("=")
+        if not sep:
+            raise ValueError(f"--where は 項目=値 の形で指定してください: {item}")
+        where.setdefault(key, []).extend(split_comma_list(value))
+    return where
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="コーパスの索引を作り、絞り込んだ文書のワードクラウドを作ります。")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    build = sub.add_parser("build", help="索引を作る")
+    build.add_argument("input", help="入力ディレクトリ、またはマニフェストファイル（.jsonl / 1行1パス）")
+    build.add_argument("index_dir", help="索引の出力先ディレクトリ")
+    build.add_argument("--settings", help="解析の条件（品詞・除外語・優先名詞）を含む設定のJSON")
+
+    cloud = sub.add_parser("cloud", help="絞り込んだ文書のワードクラウドを作る")
+    cloud.add_argument("index_dir", help="索引のディレクトリ")
+    cloud.add_argument("--where", action="append", help="絞り込み（項目=値、値はカンマ区切りでいずれか）。複数指定はすべて満たすもの")
+    cloud.add_argument("--id", action="append", dest="ids", help="文書のid（複数指定可）")
+    cloud.add_argument("--settings", help="見た目の設定のJSON（解析の条件は索引のものを使う）")
+    cloud.add_argument("--out", default="wordcloud.png", help="出力ファイル")
+    cloud.add_argument("--font", default=DEFAULT_FONT_PATH, help="フォントファイルのパス")
+    cloud.add_argument("--format", default="PNG", choices=list(IMAGE_FORMATS), help="画像の形式")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    settings = normalize_settings(load_settings(args.settings))
+
+    if args.command == "build":
+        exclude_words = split_comma_list(settings["exclude_input"])
+        if settings["use_default_stopwords"]:
+            exclude_words += get_default_japanese_stopwords()
+        n = build_index(
+            iter_documents(args.input),
+            args.index_dir,
+            settings["selected_pos"],
+            exclude_words,
+            split_comma_list(settings["priority_nouns_input"]),
+            normalize=settings["normalize_text"],
+        )
+        print(f"{n}件の文書の索引を作成しました: {args.index_dir}", file=sys.stderr)
+        return 0
+
+    if not os.path.exists(args.font):
+        print(f"フォントが見つかりません: {args.font}", file=sys.stderr)
+        return 2
+    index = CorpusIndex(args.index_dir)
+    rows = index.select(parse_where(args.where), args.ids)
+    if len(rows) == 0:
+        print("条件に合う文書がありません。", file=sys.stderr)
+        return 1
+    frequencies = index.frequencies(rows)
+    if not frequencies:
+        print("選んだ文書に単語がありません。", file=sys.stderr)
+        return 1
+
+    # matplotlib / wordcloud は画像を作るときだけ読み込む
+    from wordcloud_core import render_from_settings
+
+    data = render_from_settings(
+        settings, args.font, frequencies=frequencies, output_options={"image_format": args.format}
+    )
+    with open(args.out, "wb") as f:
+        f.write(data)
+    print(f"{len(rows)}件の文書から作成しました: {args.out}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""
+生成した画像の置き場所（全セッションで共有）。
+
+画像は中身のSHA-256（参照）で1つだけ保存し、セッションには参照だけを持たせる。
+同じ画像を生成したセッションどうしでは同じものを使う。
+
+    ref = get_image_store().put(png_bytes)
+    data = get_image_store().get(ref)  # 期限切れなどで無くなっていれば None
+
+画像はすべてディスクに書き、よく使うものだけをメモリにも置く（メモリの上限を超えたら
+最も長く使われていないものからメモリ上だけ捨てる）。ディスクの上限を超えたものと、
+WORDCLOUD_IMAGE_STORE_TTL 秒使われなかったものはディスクからも消す。
+"""
+import os
+import time
+import atexit
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+IMAGE_STORE_MEMORY_BYTES = int(os.getenv("WORDCLOUD_IMAGE_STORE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+IMAGE_STORE_DISK_BYTES = int(os.getenv("WORDCLOUD_IMAGE_STORE_DISK_BYTES", str(2 * 1024 * 1024 * 1024)))
+IMAGE_STORE_TTL = float(os.getenv("WORDCLOUD_IMAGE_STORE_TTL", str(60 * 60)))
+# 未指定ならプロセスごとの一時ディレクトリ（終了時に消す）。
+# 指定する場合も、複数のプロセスで同じディレクトリを使わないこと（互いのファイルを消してしまう）
+IMAGE_STORE_DIR = os.getenv("WORDCLOUD_IMAGE_STORE_DIR", "")
+# 期限切れの掃除をする間隔（秒）
+SWEEP_INTERVAL = 60
+
+
+class ImageStore:
+    def __init__(self, directory, memory_bytes, disk_bytes, ttl):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+        self._memory = OrderedDict()  # ref -> bytes（最近使ったものが後ろ）
+        self._memory_nbytes = 0
+        self._disk = OrderedDict()  # ref -> (バイト数, 最後に使った時刻)
+        self._disk_nbytes = 0
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.hits = 0
+        self.disk_reads = 0
+        self.misses = 0
+
+    def _path(self, ref):
+        return os.path.join(self.directory, ref)
+
+    def put(self, data):
+        """
+        画像を保存して参照を返す。同じ中身が既にあれば書き込まずに同じ参照を返す。
+        """
+        ref = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            exists = ref in self._disk
+            if exists:
+                self._touch(ref)
+                self._remember(ref, data)
+        if not exists:
+            # 書き込みはロックの外で行い、書き終わってから登録する
+            tmp = f"{self._path(ref)}.tmp{threading.get_ident()}"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self._path(ref))
+            with self._lock:
+                if ref not in self._disk:
+                    self._disk_nbytes += len(data)
+                self._disk[ref] = (len(data), time.monotonic())
+                self._remember(ref, data)
+                removed = self._evict_disk()
+            self._unlink(removed)
+        self._maybe_sweep()
+        return ref
+
+    def get(self, ref):
+        if not ref:
+            return None
+        self._maybe_sweep()
+        with self._lock:
+            entry = self._disk.get(ref)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._touch(ref)
+            data = self._memory.get(ref)
+            if data is not None:
+                self._memory.move_to_end(ref)
+                self.hits += 1
+                return data
+        try:
+            with open(self._path(ref), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            # 読む前に別のスレッドが消した
+            with self._lock:
+                self.misses += 1
+                if ref in self._disk and ref not in self._memory:
+                    self._forget(ref)
+            return None
+        with self._lock:
+            self.disk_reads += 1
+            if ref in self._disk:
+                self._remember(ref, data)
+        return data
+
+    def _touch(self, ref):
+        # ロックを取った状態で呼ぶ
+        self._disk[ref] = (self._disk[ref][0], time.monotonic())
+        self._disk.move_to_end(ref)
+
+    def _remember(self, ref, data):
+        # ロックを取った状態で呼ぶ
+        if len(data) > self.memory_bytes:
+            return
+        if ref not in self._memory:
+            self._memory_nbytes += len(data)
+        self._memory[ref] = data
+        self._memory.move_to_end(ref)
+        while self._memory_nbytes > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_nbytes -= len(evicted)
+
+    def _forget(self, ref):
+        # ロックを取った状態で呼ぶ。消すファイルのパスを返す
+        size, _ = self._disk.pop(ref)
+        self._disk_nbytes -= size
+        data = self._memory.pop(ref, None)
+        if data is not None:
+            self._memory_nbytes -= len(data)
+        return self._path(ref)
+
+    def _evict_disk(self):
+        # ロックを取った状態で呼ぶ。最後の1件（今保存したもの）は残す
+        removed = []
+        while self._disk_nbytes > self.disk_bytes and len(self._disk) > 1:
+            removed.append(self._forget(next(iter(self._disk))))
+        return removed
+
+    def _maybe_sweep(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep < SWEEP_INTERVAL:
+                return
+            self._last_sweep = now
+            removed = []
+            # _disk は最後に使った順に並んでいるので、先頭から期限切れを消す
+            while self._disk:
+                ref, (_, used_at) = next(iter(self._disk.items()))
+                if now - used_at < self.ttl:
+                    break
+                removed.append(self._forget(ref))
+        self._unlink(removed)
+
+    def _unlink(self, paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "images": len(self._disk),
+                "memory_images": len(self._memory),
+                "memory_bytes": self._memory_nbytes,
+                "disk_bytes": self._disk_nbytes,
+                "hits": self.hits,
+                "disk_reads": self.disk_reads,
+                "misses": self.misses,
+            }
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_image_store():
+    """
+    プロセスで1つの ImageStore を返す。
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                directory = IMAGE_STORE_DIR
+                if not directory:
+                    directory = tempfile.mkdtemp(prefix="wordcloud_images_")
+                    atexit.register(shutil.rmtree, directory, True)
+                _store = ImageStore(directory, IMAGE_STORE_MEMORY_BYTES, IMAGE_STORE_DISK_BYTES, IMAGE_STORE_TTL)
+    return _store
@@ -0,0 +1,317 @@
+"""
+処理段階ごとの計測（所要時間・単語数・メモリ）。
+
+    with trace() as spans:
+        with span("layout", attrs={"width": 800}) as s:
+            ...
+            s.counts["placed_words"] = n
+
+span() は trace() の外でも使える（その場合はログとプロセス全体の集計にだけ残る）。
+集計は prometheus_text() でPrometheusのテキスト形式にして出力できる。
+
+メモリは常にプロセスのRSSの最大値（ru_maxrss）を記録する。
+WORDCLOUD_TRACE_MEMORY=1 のときは tracemalloc でPythonのメモリ確保の段階ごとの最大値も記録する
+（遅くなるのでデバッグ用。tracemallocはプロセス全体で1つなので、同時に実行された処理の分も含む）。
+"""
+import os
+import time
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger("wordcloud.spans")
+startup_logger = logging.getLogger("wordcloud.startup")
+
+TRACE_MEMORY = os.getenv("WORDCLOUD_TRACE_MEMORY", "0") == "1"
+# 設定されていれば、記録のたびにこのファイルへPrometheusのテキスト形式で書き出す
+# （node_exporter の textfile collector 向け）
+METRICS_FILE = os.getenv("WORDCLOUD_METRICS_FILE", "")
+
+_current_trace = ContextVar("wordcloud_trace", default=None)
+_current_span = ContextVar("wordcloud_span", default=None)
+
+
+def _rss_high_water_bytes():
+    if resource is None:
+        return None
+    # Linuxではキロバイト単位
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _process_started_at():
+    """
+    このプロセスの起動時刻（UNIX時間）。/proc が無い環境ではこのモジュールを読み込んだ時刻。
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # 2番目の項目（コマンド名）に空白が入ることがあるので ")" の後ろから数える
+            fields = f.read().rsplit(")", 1)[1].split()
+        started_since_boot = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        return time.time() - (time.clock_gettime(time.CLOCK_BOOTTIME) - started_since_boot)
+    except Exception:
+        return time.time()
+
+
+PROCESS_STARTED_AT = _process_started_at()
+_milestones = {}
+_milestones_lock = threading.Lock()
+
+
+def mark_milestone(name):
+    """
+    プロセスの起動からの経過秒数を、name ごとに最初の1回だけ記録する
+    （first_paint: 最初のページ表示、first_cloud: 最初のワードクラウド生成 など）。
+    2回目以降は None を返す。
+    """
+    with _milestones_lock:
+        if name in _milestones:
+            return None
+        seconds = max(0.0, time.time() - PROCESS_STARTED_AT)
+        _milestones[name] = seconds
+    startup_logger.info("milestone %s seconds_since_process_start=%.3f", name, seconds)
+    return seconds
+
+
+def get_milestones():
+    with _milestones_lock:
+        return dict(_milestones)
+
+
+class Span:
+    """
+    1つの処理段階の計測結果。
+    counts は単語数などの件数（プロセス全体で合計する）、attrs は画像の大きさなどの属性（合計しない）。
+    py_peak_bytes はこの段階の開始時からPythonのメモリ確保が最大でどれだけ増えたか。
+    """
+
+    def __init__(self, name, parent=None, counts=None, attrs=None):
+        self.name = name
+        self.parent = parent
+        self.counts = dict(counts or {})
+        self.attrs = dict(attrs or {})
+        self.seconds = 0.0
+        self.rss_high_water_bytes = None
+        self.py_peak_bytes = None
+        self._py_start = 0
+        self._py_abs_peak = 0
+
+    @property
+    def depth(self):
+        depth = 0
+        parent = self.parent
+        while parent is not None:
+            depth += 1
+            parent = parent.parent
+        return depth
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "parent": self.parent.name if self.parent else None,
+            "seconds": self.seconds,
+            "counts": self.counts,
+            "attrs": self.attrs,
+            "rss_high_water_bytes": self.rss_high_water_bytes,
+            "py_peak_bytes": self.py_peak_bytes,
+        }
+
+
+@contextmanager
+def trace():
+    """
+    この中で記録された span をリストに集める（1回の生成分）。
+    """
+    spans = []
+    token = _current_trace.set(spans)
+    try:
+        yield spans
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name, attrs=None, **counts):
+    """
+    処理段階の所要時間とメモリを記録する。入れ子にした場合は親子関係も残す。
+    """
+    parent = _current_span.get()
+    record = Span(name, parent, counts, attrs)
+    tracing = TRACE_MEMORY and tracemalloc.is_tracing()
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        # 親のここまでの最大値を確定させてから、この段階の分を測り直す
+        if parent is not None:
+            parent._py_abs_peak = max(parent._py_abs_peak, peak)
+        tracemalloc.reset_peak()
+        record._py_start = record._py_abs_peak = current
+    token = _current_span.set(record)
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.seconds = time.perf_counter() - started
+        _current_span.reset(token)
+        record.rss_high_water_bytes = _rss_high_water_bytes()
+        if tracing:
+            record._py_abs_peak = max(record._py_abs_peak, tracemalloc.get_traced_memory()[1])
+            record.py_peak_bytes = record._py_abs_peak - record._py_start
+            if parent is not None:
+                parent._py_abs_peak = max(parent._py_abs_peak, record._py_abs_peak)
+        _finish(record)
+
+
+def _finish(record):
+    spans = _current_trace.get()
+    if spans is not None:
+        spans.append(record)
+    STAGE_METRICS.record(record)
+    _log(record)
+    # 一番外側の段階が終わったときにまとめて書き出す
+    if METRICS_FILE and record.parent is None:
+        write_prometheus_text(METRICS_FILE)
+
+
+def _log(record):
+    if logger.isEnabledFor(logging.INFO):
+        counts = " ".join(f"{k}={v}" for k, v in {**record.attrs, **record.counts}.items())
+        logger.info(
+            "span %s seconds=%.4f rss_high_water_mb=%s py_peak_mb=%s %s",
+            record.name,
+            record.seconds,
+            _mb(record.rss_high_water_bytes),
+            _mb(record.py_peak_bytes),
+            counts,
+        )
+
+
+def _mb(value):
+    return "-" if value is None else f"{value / (1024 * 1024):.1f}"
+
+
+def record_spans(span_dicts):
+    """
+    別プロセスで記録された span（to_dict() したもの）をこのプロセスの集計に加える。
+    """
+    for data in span_dicts:
+        record = Span(data["name"], counts=data["counts"], attrs=data.get("attrs"))
+        record.seconds = data["seconds"]
+        record.rss_high_water_bytes = data["rss_high_water_bytes"]
+        record.py_peak_bytes = data["py_peak_bytes"]
+        STAGE_METRICS.record(record)
+        _log(record)
+
+
+def configure_logging(level=None):
+    """
+    span のログを標準エラーに出す（WORDCLOUD_LOG_LEVEL で変更、既定はINFO）。
+    Streamlitは再実行のたびに呼ぶので、ハンドラは1つだけ付ける。
+    """
+    root = logging.getLogger("wordcloud")
+    root.setLevel(level or os.getenv("WORDCLOUD_LOG_LEVEL", "INFO"))
+    if not root.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+        root.addHandler(handler)
+    start_memory_tracing()
+
+
+def start_memory_tracing():
+    if TRACE_MEMORY and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+# =========================================================
+# プロセス全体の集計（Prometheusのテキスト形式）
+# =========================================================
+class StageMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def record(self, record):
+        with self._lock:
+            stage = self._stages.setdefault(
+                record.name,
+                {"calls": 0, "seconds": 0.0, "counts": {}, "rss_high_water_bytes": 0, "py_peak_bytes": 0},
+            )
+            stage["calls"] += 1
+            stage["seconds"] += record.seconds
+            for key, value in record.counts.items():
+                stage["counts"][key] = stage["counts"].get(key, 0) + value
+            stage["rss_high_water_bytes"] = max(stage["rss_high_water_bytes"], record.rss_high_water_bytes or 0)
+            stage["py_peak_bytes"] = max(stage["py_peak_bytes"], record.py_peak_bytes or 0)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                name: {**stage, "counts": dict(stage["counts"])}
+                for name, stage in self._stages.items()
+            }
+
+
+STAGE_METRICS = StageMetrics()
+
+
+def prometheus_text(extra_lines=None):
+    """
+    段階ごとの集計をPrometheusのテキスト形式で返す。
+    """
+    stages = STAGE_METRICS.snapshot()
+    lines = [
+        "# HELP wordcloud_stage_calls_total Number of times each stage ran.",
+        "# TYPE wordcloud_stage_calls_total counter",
+    ]
+    lines += [f'wordcloud_stage_calls_total{{stage="{name}"}} {s["calls"]}' for name, s in stages.items()]
+    lines += [
+        "# HELP wordcloud_stage_seconds_total Wall time spent in each stage (includes nested stages).",
+        "# TYPE wordcloud_stage_seconds_total counter",
+    ]
+    lines += [f'wordcloud_stage_seconds_total{{stage="{name}"}} {s["seconds"]:.6f}' for name, s in stages.items()]
+    lines += [
+        "# HELP wordcloud_stage_items_total Items (words, characters, bytes) handled by each stage.",
+        "# TYPE wordcloud_stage_items_total counter",
+    ]
+    for name, s in stages.items():
+        for key, value in s["counts"].items():
+            lines.append(f'wordcloud_stage_items_total{{stage="{name}",item="{key}"}} {value}')
+    lines += [
+        "# HELP wordcloud_stage_rss_high_water_bytes Process RSS high-water mark observed at the end of each stage.",
+        "# TYPE wordcloud_stage_rss_high_water_bytes gauge",
+    ]
+    lines += [
+        f'wordcloud_stage_rss_high_water_bytes{{stage="{name}"}} {s["rss_high_water_bytes"]}'
+        for name, s in stages.items()
+    ]
+    if TRACE_MEMORY:
+        lines += [
+            "# HELP wordcloud_stage_py_peak_bytes Largest growth of traced Python allocations within each stage.",
+            "# TYPE wordcloud_stage_py_peak_bytes gauge",
+        ]
+        lines += [
+            f'wordcloud_stage_py_peak_bytes{{stage="{name}"}} {s["py_peak_bytes"]}' for name, s in stages.items()
+        ]
+    milestones = get_milestones()
+    if milestones:
+        lines += [
+            "# HELP wordcloud_cold_start_seconds Seconds from process start to the first time each milestone was reached.",
+            "# TYPE wordcloud_cold_start_seconds gauge",
+        ]
+        lines += [
+            f'wordcloud_cold_start_seconds{{milestone="{name}"}} {seconds:.3f}' for name, seconds in milestones.items()
+        ]
+    lines += list(extra_lines or [])
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_text(path, extra_lines=None):
+    tmp = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(prometheus_text(extra_lines))
+    os.replace(tmp, path)
@@ -0,0 +1,178 @@
+"""
+ワードクラウド生成のバックグラウンド実行（全セッションで共有）。
+
+    job = get_job_manager().submit(key, fn, owner)
+    # 再実行のたびに job.status / job.progress / job.message を見て、終わったら job.result を使う
+
+fn(job) は別スレッドで実行される。job.report(進捗, 段階名) で進捗を知らせ、
+段階の切れ目で job.check_cancelled() を呼ぶ（取り消されていれば JobCancelled を送出する）。
+長い段階の中でも呼べばその場で止められる（単語の配置は layout_wordcloud(check_cancelled=...) に渡して途中で確かめる）。
+同じ key のジョブが実行中なら新しく実行せず、そのジョブを返す（同じ設定の二重クリック・複数タブ）。
+取り消しは、そのジョブを待っているセッション（owner）がすべて取り消したときだけ行う。
+
+fn の中では st.* を使わないこと（Streamlitのスクリプトのスレッドではないため）。
+"""
+import os
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("wordcloud.jobs")
+
+JOB_WORKERS = int(os.getenv("WORDCLOUD_JOB_WORKERS", "2"))
+# 終わったジョブの結果を残しておく秒数（画面が結果を受け取るまで）
+JOB_RESULT_TTL = float(os.getenv("WORDCLOUD_JOB_RESULT_TTL", "600"))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, key):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.status = QUEUED
+        self.progress = 0.0
+        self.message = "順番を待っています"
+        self.result = None
+        self.error = None
+        self.owners = set()
+        self.finished_at = None
+        self.future = None
+        self._cancel = threading.Event()
+
+    @property
+    def done(self):
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    @property
+    def cancel_requested(self):
+        return self._cancel.is_set()
+
+    def report(self, progress, message):
+        self.check_cancelled()
+        self.progress = progress
+        self.message = message
+
+    def check_cancelled(self):
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+
+class JobManager:
+    def __init__(self, workers, result_ttl):
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="wordcloud-job")
+        self._lock = threading.Lock()
+        self._jobs = {}  # id -> Job（終わったものも result_ttl 秒は残す）
+        self._in_flight = {}  # key -> 実行中・待機中の Job
+        self.merged = 0
+
+    def submit(self, key, fn, owner):
+        """
+        fn(job) をバックグラウンドで実行する。同じ key のジョブが実行中ならそれに相乗りする。
+        """
+        with self._lock:
+            self._sweep()
+            job = self._in_flight.get(key)
+            if job is not None and not job.cancel_requested:
+                job.owners.add(owner)
+                self.merged += 1
+                return job
+            job = Job(key)
+            job.owners.add(owner)
+            self._jobs[job.id] = job
+            self._in_flight[key] = job
+        job.future = self._executor.submit(self._run, job, fn)
+        return job
+
+    def get(self, job_id):
+        if not job_id:
+            return None
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id, owner):
+        """
+        owner がジョブを待つのをやめる。待っているセッションが無くなれば取り消す。
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.done:
+                return
+            job.owners.discard(owner)
+            if job.owners:
+                return
+            job._cancel.set()
+            if self._in_flight.get(job.key) is job:
+                del self._in_flight[job.key]
+        # まだ始まっていなければその場で取り消す（始まっていれば次の段階の切れ目で止まる）
+        if job.future is not None and job.future.cancel():
+            self._finish(job, CANCELLED)
+
+    def _run(self, job, fn):
+        if job.cancel_requested:
+            self._finish(job, CANCELLED)
+            return
+        job.status = RUNNING
+        try:
+            job.result = fn(job)
+        except JobCancelled:
+            self._finish(job, CANCELLED)
+        except Exception as e:
+            logger.exception("ジョブが失敗しました")
+            job.error = e
+            self._finish(job, FAILED)
+        else:
+            job.progress = 1.0
+            self._finish(job, DONE)
+
+    def _finish(self, job, status):
+        with self._lock:
+            job.status = status
+            job.finished_at = time.monotonic()
+            if self._in_flight.get(job.key) is job:
+                del self._in_flight[job.key]
+
+    def _sweep(self):
+        # ロックを取った状態で呼ぶ
+        now = time.monotonic()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished_at is not None and now - job.finished_at > self.result_ttl
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "jobs": len(self._jobs),
+                "in_flight": len(self._in_flight),
+                "merged": self.merged,
+            }
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager():
+    """
+    プロセスで1つの JobManager を返す。
+    """
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = JobManager(JOB_WORKERS, JOB_RESULT_TTL)
+    return _manager
@@ -0,0 +1,990 @@
+"""
+形態素解析まわりの処理（Streamlitに依存しない）。
+
+並列解析のワーカープロセスからも import されるので、
+ここでは streamlit を import しないこと。
+"""
+import os
+import io
+import re
+import csv
+import queue
+import codecs
+import atexit
+import threading
+import importlib.util
+import unicodedata
+import multiprocessing
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+from instrumentation import span
+
+
+# =========================================================
+# 形態素解析エンジン（バックエンド）
+# =========================================================
+# 既定は janome。mecab にすると速いが、辞書に無い語（半角カナと全角カナが続くところなど）の
+# 区切り方がJanomeとわずかに違うことがある（wordcloud_bench.py --only backends で確かめてから切り替える）。
+# auto は MeCab が入っていればそれを、無ければJanomeを使う
+TOKENIZER_BACKEND = os.getenv("WORDCLOUD_TOKENIZER_BACKEND", "janome")
+# MeCabに渡す引数（辞書の指定など）。未指定なら ipadic パッケージの辞書を使う
+MECAB_ARGS = os.getenv("WORDCLOUD_MECAB_ARGS", "")
+
+
+class JanomeBackend:
+    """
+    Janome（純Python）。どの環境でも動く既定のエンジン。
+    """
+
+    name = "janome"
+    modules = ("janome",)
+
+    def __init__(self):
+        # janomeは読み込みに時間がかかるので、最初の表示では import しない
+        from janome.tokenizer import Tokenizer
+
+        self._tokenizer = Tokenizer()
+
+    def analyze(self, text):
+        """
+        (表層形, 品詞, 原形) を1つずつ返す。品詞は "名詞,一般,*,*" の形、原形が無ければ '*'。
+        """
+        for token in self._tokenizer.tokenize(text):
+            yield token.surface, token.part_of_speech, token.base_form
+
+
+class MecabBackend:
+    """
+    MeCab（fugashi）。JanomeはMeCab用のIPADICをそのまま使っているので、
+    IPADICで動かせば品詞名（名詞・動詞…）も原形もJanomeと同じになる。
+    """
+
+    name = "mecab"
+    # WORDCLOUD_MECAB_ARGS で辞書を指定する場合は ipadic パッケージは要らない
+    modules = ("fugashi",) if MECAB_ARGS else ("fugashi", "ipadic")
+
+    def __init__(self):
+        import fugashi
+
+        args = MECAB_ARGS
+        if not args:
+            import ipadic
+
+            args = ipadic.MECAB_ARGS
+        self._tagger = fugashi.GenericTagger(args)
+
+    def analyze(self, text):
+        # Janomeと同じところで区切って解析する（区切りの直後は文頭として解析されるため）
+        for chunk in iter_janome_chunks(text):
+            for word in self._tagger(chunk):
+                # IPADICの素性: 品詞,細分類1,細分類2,細分類3,活用型,活用形,原形,読み,発音（未知語は読みなどが無い）
+                feature = word.feature
+                yield word.surface, ",".join(feature[:4]), feature[6] if len(feature) > 6 else "*"
+
+
+# Janome（Tokenizer.CHUNK_SIZE / MAX_CHUNK_SIZE）は長いテキストを、500文字を過ぎて最初の句読点の後
+# （無ければ1024文字）で区切って、区切りごとに別々に解析する
+JANOME_CHUNK_SIZE = 500
+JANOME_MAX_CHUNK_SIZE = 1024
+JANOME_SPLIT_CHARS = frozenset("、。,.？?！!")
+
+
+def janome_chunk_end(text, start):
+    """
+    text[start:] をJanomeが解析するとき、最初の区切りの位置を返す。
+    text が start + JANOME_MAX_CHUNK_SIZE 文字以上あれば、続きの文字によらず決まる。
+    """
+    end = min(len(text), start + JANOME_MAX_CHUNK_SIZE)
+    for pos in range(start + JANOME_CHUNK_SIZE, end):
+        if text[pos - 1] in JANOME_SPLIT_CHARS or text.endswith(("\n\n", "\r\n\r\n"), start, pos):
+            return pos
+    return end
+
+
+def iter_janome_chunks(text):
+    """
+    Janomeが1回に解析する単位と同じようにテキストを区切る。
+    """
+    text = text.strip()
+    start = 0
+    while start < len(text):
+        end = janome_chunk_end(text, start)
+        yield text[start:end]
+        start = end
+
+
+TOKENIZER_BACKENDS = {
+    "janome": JanomeBackend,
+    "mecab": MecabBackend,
+}
+# auto のときに試す順（速い順）。最後の janome は必ず使える
+AUTO_BACKEND_ORDER = ("mecab", "janome")
+
+
+def backend_installed(name):
+    """
+    エンジンに必要なパッケージが入っているか（辞書は読み込まずに import できるかだけを見る）。
+    """
+    return all(importlib.util.find_spec(module) is not None for module in TOKENIZER_BACKENDS[name].modules)
+
+
+def available_backends():
+    """
+    この環境で使えるエンジンの名前（速い順）。
+    """
+    return [name for name in AUTO_BACKEND_ORDER if backend_installed(name)]
+
+
+@lru_cache(maxsize=None)
+def resolve_backend_name(name=None):
+    """
+    使うエンジンの名前を返す（省略時は WORDCLOUD_TOKENIZER_BACKEND）。
+    """
+    name = name or TOKENIZER_BACKEND
+    if name == "auto":
+        for candidate in AUTO_BACKEND_ORDER[:-1]:
+            if backend_installed(candidate):
+                return candidate
+        return AUTO_BACKEND_ORDER[-1]
+    if name not in TOKENIZER_BACKENDS:
+        raise ValueError(f"不明な形態素解析エンジンです: {name}（{', '.join(TOKENIZER_BACKENDS)} / auto）")
+    return name
+
+
+# =========================================================
+# トークナイザのプール（全セッションで共有）
+# =========================================================
+# トークナイザの作成は辞書の読み込みで重いので、プロセス内で一度だけ作って使い回す
+TOKENIZER_POOL_SIZE = int(os.getenv("WORDCLOUD_TOKENIZER_POOL_SIZE", "4"))
+TOKENIZER_WARMUP_TEXT = "北海道の天気は晴れです。ワードクラウドを作成します。"
+
+
+class TokenizerPool:
+    """
+    トークナイザ（エンジンのインスタンス）を貸し出し式で使い回すプール。
+    Streamlitはセッションごとに別スレッドでスクリプトを実行するため、
+    同じインスタンスを複数スレッドで同時に使わないようにする。
+    """
+
+    def __init__(self, size, backend=None):
+        self.backend = resolve_backend_name(backend)
+        self.size = max(1, int(size))
+        self._pool = queue.LifoQueue()
+        for _ in range(self.size):
+            self._pool.put(TOKENIZER_BACKENDS[self.backend]())
+
+    @contextmanager
+    def acquire(self):
+        tokenizer = self._pool.get()
+        try:
+            yield tokenizer
+        finally:
+            self._pool.put(tokenizer)
+
+    def warm_up(self, text=TOKENIZER_WARMUP_TEXT):
+        # 全インスタンスで一度解析しておき、辞書の読み込みを初回クリック前に済ませる
+        tokenizers = [self._pool.get() for _ in range(self.size)]
+        try:
+            for tokenizer in tokenizers:
+                for _ in tokenizer.analyze(text):
+                    pass
+        finally:
+            for tokenizer in tokenizers:
+                self._pool.put(tokenizer)
+
+
+_tokenizer_pools = {}  # エンジンの名前 -> TokenizerPool
+_tokenizer_pool_lock = threading.Lock()
+
+
+def get_tokenizer_pool(backend=None):
+    """
+    プロセス内で共有するプールを返す（エンジンごとに初回だけ作成してウォームアップする）。
+    """
+    backend = resolve_backend_name(backend)
+    pool = _tokenizer_pools.get(backend)
+    if pool is None:
+        with _tokenizer_pool_lock:
+            pool = _tokenizer_pools.get(backend)
+            if pool is None:
+                pool = TokenizerPool(TOKENIZER_POOL_SIZE, backend)
+                pool.warm_up()
+                _tokenizer_pools[backend] = pool
+    return pool
+
+
+
+# =========================================================
+# 形態素処理
+# =========================================================
+# プレースホルダに使う私用領域（Private Use Area）
+# BMP: U+E000..U+F8FF、補助面: U+F0000..U+FFFFD, U+100000..U+10FFFD（合計137,468文字）
+PUA_RANGES = ((0xE000, 0xF8FF), (0xF0000, 0xFFFFD), (0x100000, 0x10FFFD))
+MAX_PRIORITY_NOUNS = sum(end - start + 1 for start, end in PUA_RANGES)
+PRIORITY_MATCHER_CACHE_SIZE = 16
+
+
+def _iter_placeholders():
+    for start, end in PUA_RANGES:
+        for cp in range(start, end + 1):
+            yield chr(cp)
+
+
+class PriorityNounMatcher:
+    """
+    優先名詞をまとめて探すAho-Corasick法のマッチャー。
+    テキストの長さ＋見つかった件数に比例する時間で探索できる。
+    以前の正規表現（長い語を先に並べた "a|b|c"）と同じく、
+    左から順に、その位置から始まる最も長い語を重ならないように選ぶ。
+    """
+
+    def __init__(self, words):
+        uniq = sorted(set(w for w in words if w), key=lambda w: (-len(w), w))
+        if len(uniq) > MAX_PRIORITY_NOUNS:
+            raise ValueError(f"priority_nouns が多すぎます（最大{MAX_PRIORITY_NOUNS}語まで）")
+
+        self.word_to_ph = dict(zip(uniq, _iter_placeholders()))
+        self.ph_to_word = {ph: w for w, ph in self.word_to_ph.items()}
+        self.max_len = len(uniq[0]) if uniq else 0
+
+        # トライ木（ノード番号ごとに 遷移・失敗リンク・そこで終わる語の長さ）
+        goto = [{}]
+        word_len = [0]
+        for w in uniq:
+            node = 0
+            for ch in w:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][ch] = nxt
+                    goto.append({})
+                    word_len.append(0)
+                node = nxt
+            word_len[node] = len(w)
+
+        # 幅優先で失敗リンクと、語が終わるノードへの近道（output link）を張る
+        fail = [0] * len(goto)
+        out_link = [0] * len(goto)
+        order = list(goto[0].values())
+        for node in order:
+            for ch, child in goto[node].items():
+                order.append(child)
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(ch, 0)
+                fail[child] = f
+                out_link[child] = f if word_len[f] else out_link[f]
+
+        self._goto = goto
+        self._fail = fail
+        self._word_len = word_len
+        self._out_link = out_link
+
+    def find(self, text):
+        """
+        重ならない一致を (開始位置, 語の長さ) のリストで返す（開始位置の昇順）。
+        """
+        goto = self._goto
+        fail = self._fail
+        word_len = self._word_len
+        out_link = self._out_link
+
+        # 開始位置ごとに、そこから始まる最長の語の長さ
+        longest = {}
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            n = node if word_len[node] else out_link[node]
+            while n:
+                length = word_len[n]
+                start = i - length + 1
+                if longest.get(start, 0) < length:
+                    longest[start] = length
+                n = out_link[n]
+
+        matches = []
+        pos = 0
+        for start in sorted(longest):
+            if start >= pos:
+                length = longest[start]
+                matches.append((start, length))
+                pos = start + length
+        return matches
+
+    def replace(self, text, matches=None):
+        """
+        一致した語をプレースホルダに置き換える。matches は find() の結果（省略すると探す）。
+        """
+        if matches is None:
+            matches = self.find(text)
+        parts = []
+        pos = 0
+        for start, length in matches:
+            parts.append(text[pos:start])
+            parts.append(f" {self.word_to_ph[text[start:start + length]]} ")  # 空白で分離
+            pos = start + length
+        parts.append(text[pos:])
+        return "".join(parts)
+
+
+@lru_cache(maxsize=PRIORITY_MATCHER_CACHE_SIZE)
+def _get_priority_noun_matcher(words):
+    return PriorityNounMatcher(words)
+
+
+def get_priority_noun_matcher(priority_nouns):
+    """
+    優先名詞の集合ごとにマッチャーを1回だけ作って使い回す。
+    """
+    return _get_priority_noun_matcher(frozenset(w for w in priority_nouns if w))
+
+
+def apply_priority_nouns(text, priority_nouns):
+    """
+    priority_nounsを最優先で1語として扱うため、
+    文字列中の該当箇所をプレースホルダに置換してから形態素解析に渡す。
+    """
+
+    if not priority_nouns:
+        return text, {}
+
+    matcher = get_priority_noun_matcher(priority_nouns)
+    if not matcher.ph_to_word:
+        return text, {}
+
+    return matcher.replace(text), matcher.ph_to_word
+
+# =========================================================
+# 単語の絞り込み（品詞・除外語・文字数）
+# =========================================================
+TOKEN_FILTER_CACHE_SIZE = 32
+DEFAULT_STOPWORDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stopwords_ja.txt")
+
+
+@lru_cache(maxsize=None)
+def get_default_japanese_stopwords():
+    """
+    同梱の日本語のよく使われる語（stopwords_ja.txt）。
+    """
+    with open(DEFAULT_STOPWORDS_PATH, encoding="utf-8") as f:
+        words = (line.split("#", 1)[0].strip() for line in f)
+        return tuple(w for w in words if w)
+
+
+class TokenFilter:
+    """
+    品詞・除外語・文字数で単語を選ぶ。設定ごとに1回だけ作って使い回す（get_token_filter）。
+
+    除外語は frozenset にしてあるので、除外語がいくら多くても1語あたりの判定は定数時間。
+    品詞は part_of_speech の文字列（"名詞,固有名詞,地域,一般" など）ごとに判定結果を覚えておき、
+    トークンごとに split しない（品詞の組み合わせは辞書にある数十種類だけ）。
+    normalize=True のときは単語をNFKCで正規化する（全角英数字→半角、半角カナ→全角 など）。
+    解析するテキストと優先名詞も normalize_text() で同じように正規化してから照合する。
+    """
+
+    def __init__(self, selected_pos, exclude_words, normalize=False):
+        self.selected_pos = frozenset(selected_pos)
+        self.normalize = normalize
+        self.exclude_words = frozenset(self.normalize_text(w) for w in exclude_words)
+        self._pos_allowed = {}
+
+    def normalize_text(self, text):
+        if self.normalize and not unicodedata.is_normalized("NFKC", text):
+            return unicodedata.normalize("NFKC", text)
+        return text
+
+    def pos_allowed(self, part_of_speech):
+        allowed = self._pos_allowed.get(part_of_speech)
+        if allowed is None:
+            allowed = part_of_speech.split(",", 1)[0] in self.selected_pos
+            self._pos_allowed[part_of_speech] = allowed
+        return allowed
+
+    def accept(self, word):
+        """
+        単語を残すなら（正規化した）単語を、除くなら None を返す。
+        """
+        word = self.normalize_text(word)
+        if word in self.exclude_words or len(word) <= 1:
+            return None
+        return word
+
+
+@lru_cache(maxsize=TOKEN_FILTER_CACHE_SIZE)
+def _get_token_filter(selected_pos, exclude_words, normalize):
+    return TokenFilter(selected_pos, exclude_words, normalize)
+
+
+def get_token_filter(selected_pos, exclude_words=None, normalize=False):
+    return _get_token_filter(frozenset(selected_pos), frozenset(exclude_words or ()), bool(normalize))
+
+
+def iter_japanese_words(text, selected_pos, exclude_words=None, priority_nouns=None, normalize=False, backend=None):
+    """
+    形態素解析して、条件（品詞・除外語・2文字以上）を満たす単語を1つずつ返す。
+    backend を省略すると WORDCLOUD_TOKENIZER_BACKEND のエンジンを使う。
+    """
+    text_for_tokenize, ph_to_word = prepare_japanese_text(text, priority_nouns, normalize)
+    yield from iter_prepared_words(text_for_tokenize, ph_to_word, selected_pos, exclude_words, normalize, backend)
+
+
+def normalize_priority_nouns(priority_nouns, normalize=False):
+    # 全角・半角の違う書き方の優先名詞もまとめて見つかるように、照合の前にそろえる
+    token_filter = get_token_filter((), normalize=normalize)
+    return [token_filter.normalize_text(w) for w in priority_nouns or []]
+
+
+def prepare_japanese_text(text, priority_nouns=None, normalize=False):
+    """
+    解析の前処理（正規化と優先名詞の置換）をして、(解析に渡すテキスト, プレースホルダ→優先名詞) を返す。
+    """
+    text = get_token_filter((), normalize=normalize).normalize_text(text)
+    # 名詞リストを最優先で1語化
+    return apply_priority_nouns(text, normalize_priority_nouns(priority_nouns, normalize))
+
+
+def get_priority_placeholders(priority_nouns, normalize=False):
+    """
+    prepare_japanese_text() が使う プレースホルダ→優先名詞 を返す（テキストを置換せずに）。
+    """
+    priority_nouns = normalize_priority_nouns(priority_nouns, normalize)
+    if not priority_nouns:
+        return {}
+    return get_priority_noun_matcher(priority_nouns).ph_to_word
+
+
+def iter_prepared_words(text_for_tokenize, ph_to_word, selected_pos, exclude_words=None, normalize=False, backend=None):
+    """
+    前処理済みのテキスト（prepare_japanese_text() の結果）を解析して、条件を満たす単語を1つずつ返す。
+    """
+    token_filter = get_token_filter(selected_pos, exclude_words, normalize)
+    noun_allowed = "名詞" in token_filter.selected_pos
+
+    with get_tokenizer_pool(backend).acquire() as tokenizer:
+        for surface, part_of_speech, base in tokenizer.analyze(text_for_tokenize):
+            # 置換したプレースホルダは「名詞」として扱う
+            if surface in ph_to_word:
+                if not noun_allowed:
+                    continue
+                word = ph_to_word[surface]
+            else:
+                if not token_filter.pos_allowed(part_of_speech):
+                    continue
+                # 原形が'*'の場合はsurfaceを使う
+                word = base if base != '*' else surface
+
+            word = token_filter.accept(word)
+            if word is not None:
+                yield word
+
+# WordCloud.process_text() と同じ単語の切り出し規則（min_word_length=0 の既定値では1文字の語も残る）
+WORD_PATTERN = re.compile(r"\w[\w']*")
+
+
+@lru_cache(maxsize=None)
+def get_stopwords_lower():
+    # wordcloud（matplotlibも読み込む）は最初に数えるときまで import しない
+    from wordcloud import STOPWORDS
+
+    return frozenset(w.lower() for w in STOPWORDS)
+
+def _iter_countable_words(words):
+    stopwords_lower = get_stopwords_lower()
+    for word in words:
+        if WORD_PATTERN.fullmatch(word):
+            parts = (word,)
+        else:
+            # 記号や空白を含む語は、これまでのgenerate()と同じく\wの並びに分割する
+            parts = WORD_PATTERN.findall(word)
+        for w in parts:
+            if w.lower().endswith("'s"):
+                w = w[:-2]
+            if w.isdigit() or w.lower() in stopwords_lower:
+                continue
+            yield w
+
+def count_raw_words(words):
+    """
+    単語のiterableを数える（大文字小文字・複数形の統合前）。
+    結果のCounterはチャンクごとに足し合わせられる。
+    """
+    return Counter(_iter_countable_words(words))
+
+def fuse_word_counts(raw_counts):
+    """
+    wordcloud.tokenization.process_tokens() と同じ規則で
+    大文字小文字の表記ゆれと英語の複数形をまとめる（単語列ではなく出現回数から）。
+    """
+    with span("count", raw_unique_words=len(raw_counts)) as s:
+        counts = _fuse_word_counts(raw_counts)
+        s.counts["unique_words"] = len(counts)
+    return counts
+
+def _fuse_word_counts(raw_counts):
+    d = {}
+    for word, count in raw_counts.items():
+        case_dict = d.setdefault(word.lower(), {})
+        case_dict[word] = case_dict.get(word, 0) + count
+
+    for key in list(d.keys()):
+        if key.endswith('s') and not key.endswith("ss"):
+            key_singular = key[:-1]
+            if key_singular in d:
+                dict_singular = d[key_singular]
+                for word, count in d[key].items():
+                    singular = word[:-1]
+                    dict_singular[singular] = dict_singular.get(singular, 0) + count
+                del d[key]
+
+    counts = {}
+    for case_dict in d.values():
+        # 最も多い表記を代表にする
+        first = max(case_dict.items(), key=lambda x: x[1])[0]
+        counts[first] = sum(case_dict.values())
+    return counts
+
+def count_words(words):
+    """
+    単語のiterableから 単語→出現回数 のdictを作る。
+    これまで WordCloud.generate() が文字列を再分割して行っていた
+    数字・英語ストップワードの除去、大文字小文字と複数形の統合を同じ規則で行う。
+    """
+    return fuse_word_counts(count_raw_words(words))
+
+def tokenize_japanese(text, selected_pos, exclude_words=None, priority_nouns=None, normalize=False, backend=None):
+    """
+    テキストを解析して 単語→出現回数 のdictを返す。
+    """
+    return count_words(iter_japanese_words(text, selected_pos, exclude_words, priority_nouns, normalize, backend))
+
+
+
+# =========================================================
+# 大きなファイルの読み込み（チャンクごとに解析して集計）
+# =========================================================
+# 1回に解析する文字数の目安。メモリ使用量はコーパス全体ではなくこの大きさで決まる
+STREAM_CHUNK_CHARS = int(os.getenv("WORDCLOUD_STREAM_CHUNK_CHARS", str(64 * 1024)))
+SENTENCE_END_CHARS = "。！？!?\n"
+
+
+def detect_encoding(binary, block_size=64 * 1024):
+    """
+    UTF-8（BOM付き含む）かShift_JIS(cp932)かを判定する。
+    先頭がASCIIだけのShift_JISのファイルもあるので、最後までUTF-8として読めるかを確かめる。
+    """
+    head = binary.read(len(codecs.BOM_UTF8))
+    binary.seek(0)
+    if head == codecs.BOM_UTF8:
+        return "utf-8-sig"
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        # 読み込みの単位で切れた多バイト文字は次の読み込みでつなぐ（末尾で切れているものもエラーにしない）
+        for block in iter(lambda: binary.read(block_size), b""):
+            decoder.decode(block, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "cp932"
+    finally:
+        binary.seek(0)
+
+
+@contextmanager
+def open_text_stream(binary, encoding=None):
+    binary.seek(0)
+    encoding = encoding or detect_encoding(binary)
+    stream = io.TextIOWrapper(binary, encoding=encoding, errors="replace", newline="")
+    try:
+        yield stream
+    finally:
+        # TextIOWrapperが元のファイルを閉じないように切り離す
+        stream.detach()
+
+
+def _last_sentence_end(buf):
+    return max(buf.rfind(c) for c in SENTENCE_END_CHARS)
+
+
+def iter_text_chunks(stream, chunk_chars=STREAM_CHUNK_CHARS):
+    """
+    テキストストリームを chunk_chars 文字程度ずつ、文末で区切って返す。
+    文末がなかなか現れない場合は chunk_chars の4倍で強制的に区切る。
+    """
+    rest = ""
+    while True:
+        block = stream.read(chunk_chars)
+        if not block:
+            break
+        buf = rest + block
+        cut = _last_sentence_end(buf) + 1
+        if cut == 0:
+            if len(buf) < chunk_chars * 4:
+                rest = buf
+                continue
+            cut = len(buf)
+        yield buf[:cut]
+        rest = buf[cut:]
+    if rest:
+        yield rest
+
+
+def iter_csv_chunks(stream, chunk_chars=STREAM_CHUNK_CHARS):
+    """
+    CSVのセルを改行区切りでまとめ、chunk_chars 文字程度ずつ返す（区切りの「,」は解析しない）。
+    返したものをつなげると、すべてのセルを改行でつないだテキストになる。
+    """
+    buf = []
+    size = 0
+    for row in csv.reader(stream):
+        for cell in row:
+            if cell:
+                buf.append(cell)
+                size += len(cell) + 1
+        if size >= chunk_chars:
+            yield "\n".join(buf) + "\n"
+            buf = []
+            size = 0
+    if buf:
+        yield "\n".join(buf) + "\n"
+
+
+def _normalize_cut(raw):
+    # 文末の記号（後ろの文字と合成されない）の直後で切れば、前後を別々に正規化しても全体と同じになる
+    cut = _last_sentence_end(raw) + 1
+    if cut == 0 and len(raw) >= STREAM_CHUNK_CHARS * 4:
+        # 文末がなかなか現れない場合は、前の文字と合成されないASCII文字の前で切る
+        cut = next((i for i in range(len(raw) - 1, 0, -1) if raw[i].isascii()), len(raw))
+    return cut
+
+
+def _replace_settled(matcher, text):
+    """
+    続きの文字によって一致が変わらないところまでを置換して、(置換したテキスト, 残り) を返す。
+    """
+    # 最も長い語より短い末尾は、続きの文字でもっと長い語に一致するかもしれない
+    cut = len(text) - matcher.max_len + 1
+    settled = []
+    for start, length in matcher.find(text):
+        if start >= cut:
+            break
+        if start + length > cut:
+            cut = start
+            break
+        settled.append((start, length))
+    if cut <= 0:
+        return "", text
+    return matcher.replace(text[:cut], settled), text[cut:]
+
+
+def iter_prepared_text(pieces, priority_nouns=None, normalize=False):
+    """
+    テキストの断片を順に前処理（正規化と優先名詞の置換）して返す。
+    返したものをつなげると、断片をつないでから prepare_japanese_text() した結果と同じになる。
+    """
+    normalize_text = get_token_filter((), normalize=normalize).normalize_text
+    priority_nouns = normalize_priority_nouns(priority_nouns, normalize)
+    matcher = get_priority_noun_matcher(priority_nouns) if priority_nouns else None
+    if matcher is not None and not matcher.ph_to_word:
+        matcher = None
+
+    raw = ""  # まだ正規化していない部分
+    text = ""  # 正規化して、まだ置換していない部分
+    for piece in pieces:
+        raw += piece
+        cut = _normalize_cut(raw) if normalize else len(raw)
+        text += normalize_text(raw[:cut])
+        raw = raw[cut:]
+        if matcher is None:
+            prepared, text = text, ""
+        else:
+            prepared, text = _replace_settled(matcher, text)
+        if prepared:
+            yield prepared
+    text += normalize_text(raw)
+    if text:
+        yield matcher.replace(text) if matcher else text
+
+
+def _iter_streamed_janome_chunks(pieces):
+    # iter_janome_chunks() と同じ区切りを、テキスト全体を持たずに求める
+    buf = ""
+    started = False
+    for piece in pieces:
+        if not started:
+            # 先頭の空白はJanomeと同じく解析しない（末尾の空白は最後のブロックを解析するときにJanomeが削る）
+            piece = piece.lstrip()
+            started = bool(piece)
+        buf += piece
+        start = 0
+        while len(buf) - start >= JANOME_MAX_CHUNK_SIZE:
+            end = janome_chunk_end(buf, start)
+            yield buf[start:end]
+            start = end
+        buf = buf[start:]
+    start = 0
+    while start < len(buf):
+        end = janome_chunk_end(buf, start)
+        yield buf[start:end]
+        start = end
+
+
+def iter_janome_blocks(pieces, block_chars=STREAM_CHUNK_CHARS):
+    """
+    前処理済みのテキストの断片を、Janomeが区切る位置で block_chars 文字程度ずつにまとめ直して返す。
+    Janomeは区切りの直後を文頭として解析するので、ほかの位置で切ると単語の区切り方が変わる。
+    前後の空白を削ってから解析するので、境目は前後が空白でない区切りだけにする。
+    ブロックごとに解析して足し合わせれば、全体を1回で解析した結果と同じになる。
+    """
+    block = []
+    size = 0
+    for chunk in _iter_streamed_janome_chunks(pieces):
+        if size >= block_chars and not block[-1][-1].isspace() and not chunk[0].isspace():
+            yield "".join(block)
+            block = []
+            size = 0
+        block.append(chunk)
+        size += len(chunk)
+    if block:
+        yield "".join(block)
+
+
+def iter_keyed_blocks(keyed_chunks, priority_nouns=None, normalize=False, block_chars=STREAM_CHUNK_CHARS):
+    """
+    (キー, チャンク) を、同じキーが続く間は1つのテキストとして前処理し、Janomeの区切りでまとめ直して返す。
+    空のテキストでも (キー, "") を1つ返す。
+    """
+    for key, group in groupby(keyed_chunks, key=itemgetter(0)):
+        pieces = (chunk for _, chunk in group)
+        empty = True
+        for block in iter_janome_blocks(iter_prepared_text(pieces, priority_nouns, normalize), block_chars):
+            empty = False
+            yield key, block
+        if empty:
+            yield key, ""
+
+
+def iter_raw_counts(keyed_chunks, selected_pos, exclude_words=None, priority_nouns=None, normalize=False):
+    """
+    (キー, チャンク) を解析し、(キー, count_raw_words() の結果) をブロックごとに返す。
+    """
+    ph_to_word = get_priority_placeholders(priority_nouns, normalize)
+    for key, block in iter_keyed_blocks(keyed_chunks, priority_nouns, normalize):
+        yield key, count_raw_words(iter_prepared_words(block, ph_to_word, selected_pos, exclude_words, normalize))
+
+
+def count_words_from_chunks(chunks, selected_pos, exclude_words=None, priority_nouns=None, normalize=False):
+    """
+    チャンク（つなげると1つのテキストになるもの）を解析して集計する。
+    全体を tokenize_japanese() した場合と同じ 単語→出現回数 になる。
+    """
+    raw_counts = Counter()
+    keyed_chunks = ((None, chunk) for chunk in chunks)
+    for _, counts in iter_raw_counts(keyed_chunks, selected_pos, exclude_words, priority_nouns, normalize):
+        raw_counts.update(counts)
+    return fuse_word_counts(raw_counts)
+
+
+
+# =========================================================
+# 重複する文をまとめて解析（SNSの投稿・引用の繰り返しなど）
+# =========================================================
+SENTENCE_SPLIT_PATTERN = re.compile(f"(?<=[{re.escape(SENTENCE_END_CHARS)}])")
+
+
+def count_sentences(text):
+    """
+    文（または行）ごとに出現回数を数える。順序は最初に出てきた順。
+    """
+    units = Counter()
+    for unit in SENTENCE_SPLIT_PATTERN.split(text):
+        unit = unit.strip()
+        if unit:
+            units[unit] += 1
+    return units
+
+
+def _iter_dedup_batches(units, chunk_chars):
+    # 出現回数が同じ文が続く間は改行でつないで1回の解析にまとめる
+    batch = []
+    batch_times = None
+    size = 0
+    for unit, times in units.items():
+        if batch and (times != batch_times or size >= chunk_chars):
+            yield "\n".join(batch), batch_times
+            batch = []
+            size = 0
+        batch.append(unit)
+        batch_times = times
+        size += len(unit) + 1
+    if batch:
+        yield "\n".join(batch), batch_times
+
+
+def tokenize_japanese_dedup(
+    text, selected_pos, exclude_words=None, priority_nouns=None, chunk_chars=STREAM_CHUNK_CHARS, normalize=False
+):
+    """
+    同じ文は1回だけ解析し、出現回数を掛けて集計する。
+    最初に出てきた順に解析するので、単語の並びも通常の解析と同じになる。
+
+    戻り値: (単語→出現回数 のdict, 省略できた量の統計dict)
+    """
+    units = count_sentences(text)
+    raw_counts = Counter()
+    for batch, times in _iter_dedup_batches(units, chunk_chars):
+        counts = count_raw_words(iter_japanese_words(batch, selected_pos, exclude_words, priority_nouns, normalize))
+        if times > 1:
+            for word in counts:
+                counts[word] *= times
+        raw_counts.update(counts)
+
+    total_chars = sum(len(unit) * times for unit, times in units.items())
+    unique_chars = sum(len(unit) for unit in units)
+    stats = {
+        "sentences": sum(units.values()),
+        "unique_sentences": len(units),
+        "chars": total_chars,
+        "tokenized_chars": unique_chars,
+        "saved_ratio": (1 - unique_chars / total_chars) if total_chars else 0.0,
+    }
+    return fuse_word_counts(raw_counts), stats
+
+
+
+# =========================================================
+# 大きな入力の並列解析（プロセスプール）
+# =========================================================
+# 形態素解析（特にJanomeは純Python）は1コアしか使えないので、大きな入力はJanomeの区切りで分割して複数プロセスで解析する
+PARALLEL_MIN_CHARS = int(os.getenv("WORDCLOUD_PARALLEL_MIN_CHARS", str(200_000)))
+PARALLEL_WORKERS = int(os.getenv("WORDCLOUD_PARALLEL_WORKERS", str(os.cpu_count() or 1)))
+# 投入済みで結果待ちのシャード数の上限（ワーカー数の倍数）。メモリ使用量を抑えるため
+PARALLEL_MAX_IN_FLIGHT_PER_WORKER = 2
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def _init_worker():
+    # ワーカーごとに長生きするトークナイザを1つだけ持つ
+    # （fork元のプールは別スレッドが使用中だった可能性があるので作り直す）
+    global _tokenizer_pools
+    pool = TokenizerPool(1)
+    pool.warm_up()
+    _tokenizer_pools = {pool.backend: pool}
+
+
+def _count_shard(shard, selected_pos, exclude_words, priority_nouns, normalize=False):
+    # shard は前処理済み（iter_keyed_blocks() の結果）なので、プレースホルダを戻すだけ
+    ph_to_word = get_priority_placeholders(priority_nouns, normalize)
+    return count_raw_words(iter_prepared_words(shard, ph_to_word, selected_pos, exclude_words, normalize))
+
+
+def parallel_enabled():
+    return PARALLEL_WORKERS > 1
+
+
+def get_process_pool():
+    """
+    プロセス内で共有するワーカープールを返す（クリックごとにforkしない）。
+    """
+    global _process_pool
+    if _process_pool is None:
+        with _process_pool_lock:
+            if _process_pool is None:
+                # spawn / forkserver だとワーカー起動時にStreamlitのスクリプト（__main__）が
+                # 再実行されてしまうので、使える環境ではforkで起動する
+                if "fork" in multiprocessing.get_all_start_methods():
+                    mp_context = multiprocessing.get_context("fork")
+                else:
+                    mp_context = None
+                _process_pool = ProcessPoolExecutor(
+                    max_workers=PARALLEL_WORKERS,
+                    mp_context=mp_context,
+                    initializer=_init_worker,
+                )
+    return _process_pool
+
+
+def _discard_process_pool(broken):
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is broken:
+            _process_pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+@atexit.register
+def shutdown_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        pool, _process_pool = _process_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_raw_counts_parallel(
+    keyed_chunks, selected_pos, exclude_words=None, priority_nouns=None, normalize=False,
+    block_chars=STREAM_CHUNK_CHARS,
+):
+    """
+    (キー, チャンク) をワーカープロセスで解析し、(キー, count_raw_words() の結果) を投入順に返す。
+    iter_raw_counts() と同じく、同じキーが続くチャンクはJanomeの区切りでまとめ直してから振り分ける。
+    """
+    executor = get_process_pool()
+    exclude_words = list(exclude_words or [])
+    priority_nouns = list(priority_nouns or [])
+    max_in_flight = PARALLEL_WORKERS * PARALLEL_MAX_IN_FLIGHT_PER_WORKER
+
+    in_flight = deque()
+    try:
+        for key, chunk in iter_keyed_blocks(keyed_chunks, priority_nouns, normalize, block_chars):
+            in_flight.append(
+                (key, executor.submit(_count_shard, chunk, selected_pos, exclude_words, priority_nouns, normalize))
+            )
+            if len(in_flight) >= max_in_flight:
+                key, future = in_flight.popleft()
+                yield key, future.result()
+        while in_flight:
+            key, future = in_flight.popleft()
+            yield key, future.result()
+    except BrokenProcessPool:
+        # ワーカーが落ちた場合は次回作り直す
+        _discard_process_pool(executor)
+        raise
+    finally:
+        for _, future in in_flight:
+            future.cancel()
+
+
+def count_words_parallel(chunks, selected_pos, exclude_words=None, priority_nouns=None, normalize=False):
+    """
+    チャンク（つなげると1つのテキストになるもの）をワーカープロセスで解析して集計する。
+    Janomeの区切りで分けて解析するので、全体を tokenize_japanese() した場合と同じ 単語→出現回数 になる。
+    """
+    raw_counts = Counter()
+    keyed_chunks = ((None, chunk) for chunk in chunks)
+    for _, counts in iter_raw_counts_parallel(keyed_chunks, selected_pos, exclude_words, priority_nouns, normalize):
+        raw_counts.update(counts)
+    return fuse_word_counts(raw_counts)
+
+
+def tokenize_japanese_parallel(text, selected_pos, exclude_words=None, priority_nouns=None, normalize=False):
+    """
+    大きなテキストをJanomeの区切りで分割して並列に解析し、単語→出現回数 のdictを返す。
+    """
+    # ワーカー数の数倍に分けて、シャードごとの処理時間のばらつきをならす
+    shard_chars = max(STREAM_CHUNK_CHARS, len(text) // (PARALLEL_WORKERS * 4) + 1)
+    raw_counts = Counter()
+    keyed_chunks = [(None, text)]
+    for _, counts in iter_raw_counts_parallel(
+        keyed_chunks, selected_pos, exclude_words, priority_nouns, normalize, block_chars=shard_chars
+    ):
+        raw_counts.update(counts)
+    return fuse_word_counts(raw_counts)
@@ -0,0 +1,59 @@
+"""
+起動直後の準備をバックグラウンドで行う（形態素解析の辞書・生成用ライブラリ・フォントの読み込み）。
+
+Streamlitアプリは最初のページを表示した後に start_background_warmup() を呼ぶ。
+最初の「ワードクラウドを生成」までに終わっていれば、そのクリックで待たされない。
+（終わる前にクリックされた場合も、同じロックを待つだけで二重には読み込まない）
+"""
+import os
+import logging
+import threading
+
+from instrumentation import mark_milestone, span
+
+logger = logging.getLogger("wordcloud.startup")
+
+# 0 にするとバックグラウンドでの準備をしない（最初の生成のときに読み込む）
+BACKGROUND_WARMUP = os.getenv("WORDCLOUD_BACKGROUND_WARMUP", "1") == "1"
+
+_started = False
+_started_lock = threading.Lock()
+
+
+def warm_up(font_path):
+    """
+    生成に必要なものを一通り読み込んでおく。
+    """
+    with span("warmup"):
+        from morphology import get_stopwords_lower, get_tokenizer_pool
+
+        get_tokenizer_pool()
+        get_stopwords_lower()
+        # matplotlib / numpy / wordcloud / PIL
+        import wordcloud_core
+
+        if font_path and os.path.exists(font_path):
+            wordcloud_core.warm_up_font(font_path)
+    mark_milestone("warmup_done")
+
+
+def _run(font_path):
+    try:
+        warm_up(font_path)
+    except Exception:
+        logger.exception("バックグラウンドでの準備に失敗しました")
+
+
+def start_background_warmup(font_path):
+    """
+    プロセス内で最初の1回だけ、別スレッドで warm_up() を始める。始めた場合は True。
+    """
+    global _started
+    if not BACKGROUND_WARMUP:
+        return False
+    with _started_lock:
+        if _started:
+            return False
+        _started = True
+    threading.Thread(target=_run, args=(font_path,), name="wordcloud-warmup", daemon=True).start()
+    return True
@@ -1,18 +1,35 @@
-import os
 import io
+import os
 import re
+import copy
+import time
+import functools
 import json
+import hashlib
 import uuid
 import secrets
 from datetime import datetime, timezone, timedelta
 import streamlit as st
-from janome.tokenizer import Tokenizer
-from wordcloud import WordCloud
-import matplotlib
-import matplotlib.pyplot as plt
-from matplotlib import cm
 from streamlit_cookies_manager import EncryptedCookieManager
-import numpy as np
+# matplotlib / wordcloud / janome を読み込む wordcloud_core は、生成するときに import する
+# （最初のページ表示を速くするため）
+from instrumentation import configure_logging, mark_milestone, trace
+from morphology import get_default_japanese_stopwords
+from image_store import get_image_store
+from jobs import DONE, FAILED, get_job_manager
+from warmup import start_background_warmup
+from wordcloud_settings import (
+    COLOR_SETTING_KEYS,
+    DEFAULT_SETTINGS,
+    IMAGE_FORMATS,
+    OUTPUT_OPTION_RANGES,
+    PREVIEW_MAX_SIDE,
+    SETTING_RANGES,
+    decode_history,
+    encode_history,
+    preview_scale_for,
+    split_comma_list,
+)
 
 
 # =========================================================
@@ -66,58 +83,108 @@ div.stButton > button[kind="primary"]:hover{
 # =========================================================
 # 先に初期化
 # =========================================================
-st.session_state.setdefault("last_png", None)
+# 画像そのものは image_store に置き、セッションには参照だけを持たせる
+st.session_state.setdefault("last_image_ref", None)
+st.session_state.setdefault("last_image_format", "PNG")
+st.session_state.setdefault("last_full_image_ref", None) # プレビューモードの原寸画像
+st.session_state.setdefault("last_layout", None) # 前回の配置（色だけ変えたときに使い回す）
+st.session_state.setdefault("last_layout_key", None)
 st.session_state.setdefault("last_settings", None) # 保存用（設定のみ）
+st.session_state.setdefault("last_spans", None) # 前回の生成の段階ごとの計測結果
 st.session_state.setdefault("flash", None) # 簡易メッセージ
 st.session_state.setdefault("pending_load_settings", None)
 st.session_state.setdefault("pending_load_name", None)
+st.session_state.setdefault("session_id", uuid.uuid4().hex) # ジョブの相乗り・キャンセルの単位
+st.session_state.setdefault("job_id", None) # 実行中の生成ジョブ
+st.session_state.setdefault("job_meta", None) # 実行中のジョブの設定（結果を受け取るときに使う）
 
 # =========================================================
 # Cookieで内容保存
 # =========================================================
 JST = timezone(timedelta(hours=9))
 
-HISTORY_COOKIE_KEY = "history_v1"
-MAX_HISTORY = 10  # cookie容量の都合で多すぎないように
+# 圧縮形式（wordcloud_settings.encode_history）で保存する。history_v1 は以前の形式（JSONそのまま）
+HISTORY_COOKIE_KEY = "history_v2"
+LEGACY_HISTORY_COOKIE_KEY = "history_v1"
+MAX_HISTORY = 50  # cookie容量の都合で多すぎないように
+# cookieは容量制限が厳しい（一般に 4KB 程度）。EncryptedCookieManagerは暗号化・エンコードで
+# さらに増えるので少し余裕を見る
+MAX_HISTORY_BYTES = 2800
 COOKIE_PASSWORD = os.getenv("WORDCLOUD_COOKIE_PASSWORD", "change-me-please")
 
 cookies = EncryptedCookieManager(prefix="wordcloud_", password=COOKIE_PASSWORD)
-if not cookies.ready():
-    st.stop()
+# cookieはブラウザから届くまで読めない（届くと自動で再実行される）。
+# 届く前でもページは表示し、保存した設定の欄だけ後から表示する
+COOKIES_READY = cookies.ready()
 
 
 def _now_iso_jst():
     return datetime.now(JST).isoformat(timespec="seconds")
 
 
-def load_history():
+# この再実行の中で読んだ保存履歴（スクリプトは再実行のたびに最初から実行されるので、
+# 再実行ごとに1回だけcookieを復号・展開する）
+_history_memo = None
+
+
+def _read_history_cookie():
     raw = cookies.get(HISTORY_COOKIE_KEY)
+    if raw:
+        return decode_history(raw, JST)
+    raw = cookies.get(LEGACY_HISTORY_COOKIE_KEY)
     if not raw:
         return []
     try:
         data = json.loads(raw)
-        if isinstance(data, list):
-            return data
+    except Exception:
         return []
+    if not isinstance(data, list):
+        return []
+    history = [x for x in data if isinstance(x, dict)]
+    # 以前の形式から移行する（大きいcookieが毎回送られないように、読んだ時点で書き換える）
+    try:
+        history = save_history(history)
     except Exception:
+        pass
+    return history
+
+
+def load_history():
+    global _history_memo
+    if not COOKIES_READY:
         return []
+    if _history_memo is None:
+        _history_memo = _read_history_cookie()
+    # 呼び出し側で書き換えても覚えている内容が変わらないように複製して返す
+    return copy.deepcopy(_history_memo)
 
 
 def save_history(history):
-    # cookieは容量制限が厳しい（一般に 4KB 程度）ので、保存件数を制限しつつ
-    # それでも大きすぎる場合はエラーにする。
-    history = history[-MAX_HISTORY:]
-    raw = json.dumps(history, ensure_ascii=False, separators=(",", ":"))
+    """
+    保存履歴をcookieに書き込む。戻り値は実際に保存した履歴（古いものを削った後）。
+    """
+    global _history_memo
+    if not COOKIES_READY:
+        raise RuntimeError("cookieの読み込みが終わっていません。少し待ってからもう一度お試しください。")
 
-    # EncryptedCookieManagerは暗号化・エンコードでさらに増えるので少し余裕を見てチェック
-    if len(raw.encode("utf-8")) > 2800:
+    # 保存件数を制限し、それでも容量を超える場合は古いものから削る
+    history = history[-MAX_HISTORY:]
+    raw = encode_history(history)
+    while len(raw) > MAX_HISTORY_BYTES and len(history) > 1:
+        history = history[1:]
+        raw = encode_history(history)
+    if len(raw) > MAX_HISTORY_BYTES:
         raise ValueError(
             "保存データが大きすぎます。"
             "（設定数を調整してください）"
         )
 
     cookies[HISTORY_COOKIE_KEY] = raw
+    if LEGACY_HISTORY_COOKIE_KEY in cookies:
+        del cookies[LEGACY_HISTORY_COOKIE_KEY]
     cookies.save()
+    _history_memo = copy.deepcopy(history)
+    return history
 
 
 def delete_history_item(item_id: str):
@@ -136,8 +203,7 @@ def rename_history_item(item_id: str, new_name: str):
 
 
 def reset_history():
-    cookies[HISTORY_COOKIE_KEY] = json.dumps([], ensure_ascii=False)
-    cookies.save()
+    save_history([])
 
 
 def make_default_name(history) -> str:
@@ -225,6 +291,8 @@ if pending:
     # 値を反映
     st.session_state["wc_priority_nouns_input"] = settings.get("priority_nouns_input", "")
     st.session_state["wc_exclude_input"] = settings.get("exclude_input", "")
+    st.session_state["wc_use_default_stopwords"] = bool(settings.get("use_default_stopwords", False))
+    st.session_state["wc_normalize_text"] = bool(settings.get("normalize_text", False))
 
     loaded_pos = settings.get("selected_pos", ["名詞"])
     if not isinstance(loaded_pos, list):
@@ -245,8 +313,14 @@ if pending:
     st.session_state["wc_background_color"] = settings.get("background_color", "#f4f5f7")
     st.session_state["wc_check_contrast"] = bool(settings.get("check_contrast", True))
     st.session_state["wc_colormap"] = settings.get("colormap", "viridis")
-
-    st.session_state["last_png"] = None
+    st.session_state["wc_contour_width"] = _to_int(settings.get("contour_width", 0), 0)
+    st.session_state["wc_contour_color"] = settings.get("contour_color", "#000000")
+    # 同じシードなら同じ配置・配色になる（古い保存データには無い）
+    if settings.get("seed") is not None:
+        st.session_state["wc_seed"] = _to_int(settings["seed"], None)
+
+    st.session_state["last_image_ref"] = None
+    st.session_state["last_full_image_ref"] = None
     st.session_state["last_settings"] = None
 
     nm = st.session_state.get("pending_load_name") or "設定"
@@ -254,156 +328,262 @@ if pending:
     st.session_state["flash"] = f"「{nm}」を読み込みました"
 
 
-
 # =========================================================
-# 形態素処理
+# ログと計測
 # =========================================================
-def apply_priority_nouns(text, priority_nouns):
+# Janomeの辞書やフォントはページの表示後にバックグラウンドで読み込む（一番下の start_background_warmup）
+
+# 段階ごとの計測結果をログに出す（WORDCLOUD_LOG_LEVEL で変更）
+configure_logging()
+# 1なら画像の下に計測結果（デバッグ用）を表示する
+SHOW_SPANS = os.getenv("WORDCLOUD_DEBUG_SPANS", "0") == "1"
+
+
+
+def spans_table(spans):
     """
-    priority_nounsを最優先で1語として扱うため、
-    文字列中の該当箇所をプレースホルダに置換してからJanomeに渡す。
+    計測結果をデバッグ表示用の行に変換する（入れ子の段階は親の下に字下げして並べる）。
     """
+    rows = []
+    # 子の段階は親より先に終わるので、親が出てくるまで取っておく
+    children = []
+
+    def add(sp, depth):
+        rows.append({
+            "段階": "　" * depth + sp["name"],
+            "秒": round(sp["seconds"], 4),
+            "件数": ", ".join(f"{k}={v}" for k, v in {**sp.get("attrs", {}), **sp["counts"]}.items()),
+            "RSS最大(MB)": round((sp["rss_high_water_bytes"] or 0) / (1024 * 1024), 1),
+            "Python確保最大(MB)": round(sp["py_peak_bytes"] / (1024 * 1024), 1) if sp["py_peak_bytes"] else None,
+        })
+        for child in [c for c in children if c["parent"] == sp["name"]]:
+            children.remove(child)
+            add(child, depth + 1)
+
+    for sp in spans:
+        if sp["parent"]:
+            children.append(sp)
+        else:
+            add(sp, 0)
+    return rows
 
-    if not priority_nouns:
-        return text, {}
 
-    uniq = sorted(set([w for w in priority_nouns if w]), key=len, reverse=True)
-    if not uniq:
-        return text, {}
+def export_full_resolution():
+    """
+    プレビュー（縮小して配置）と同じ配置のまま、原寸の画像を作成する。戻り値は image_store の参照。
+    """
+    from wordcloud_core import (
+        color_wordcloud,
+        get_image_cache,
+        get_layout_cache,
+        make_image_cache_key,
+        render_wordcloud_to_bytes,
+    )
 
-    # BMP Private Use Area: U+E000 .. U+F8FF (6400文字)
-    PUA_START = 0xE000
-    PUA_END = 0xF8FF
-    if len(uniq) > (PUA_END - PUA_START + 1):
-        raise ValueError("priority_nouns が多すぎます（最大6400語まで）")
+    layout_key = st.session_state.get("last_export_layout_key")
+    layout_scale = st.session_state.get("last_layout_scale", 1)
+    output_options = st.session_state.get("last_output_options") or {}
+    settings = st.session_state.get("last_settings") or {}
+
+    image_cache = get_image_cache()
+    image_store = get_image_store()
+    full_key = make_image_cache_key(layout_key, settings, None, {**output_options, "full": True})
+    ref = image_cache.get(full_key)
+    if ref is None or image_store.get(ref) is None:
+        if st.session_state.get("last_layout_key") == layout_key:
+            layout = st.session_state.get("last_layout")
+        else:
+            layout = get_layout_cache().get(layout_key)
+        if layout is None:
+            raise RuntimeError("配置データが見つかりません。もう一度「ワードクラウドを生成」を押してください。")
+        wordcloud = color_wordcloud(
+            layout,
+            settings["background_color"],
+            settings["colormap"],
+            settings["check_contrast"],
+            settings["seed"],
+            settings.get("contour_width", 0),
+            settings.get("contour_color", "#000000"),
+        )
+        data = render_wordcloud_to_bytes(
+            wordcloud,
+            output_options.get("image_format", "PNG"),
+            compress_level=output_options.get("png_compress_level", 6),
+            quality=output_options.get("quality", 90),
+            scale=layout_scale,
+            size=(int(settings["width"]), int(settings["height"])),
+        )
+        ref = image_store.put(data)
+        image_cache.put(full_key, ref)
+    return ref
+
+
+# =========================================================
+# 生成ジョブ（バックグラウンドで実行し、画面は進捗を表示して待つ）
+# =========================================================
+# 進捗を確認する間隔（秒）
+JOB_POLL_INTERVAL = float(os.getenv("WORDCLOUD_JOB_POLL_INTERVAL", "0.5"))
+HAS_FRAGMENT = hasattr(st, "fragment")
 
-    word_to_ph = {}
-    ph_to_word = {}
-    for i, w in enumerate(uniq):
-        ph = chr(PUA_START + i)  # 1文字プレースホルダ
-        word_to_ph[w] = ph
-        ph_to_word[ph] = w
 
-    pattern = re.compile("|".join(map(re.escape, uniq)))
+def run_generation(job, request):
+    """
+    ワードクラウドを1枚生成する（jobs のワーカースレッドで実行するので st.* は使わない）。
+    段階の切れ目で進捗を知らせ、キャンセルされていればそこで止める。
+    いちばん長い単語の配置は、配置の途中でもキャンセルを確かめる（テキストの解析は解析し終わってから止まる）。
+    """
+    from wordcloud_core import (
+        color_wordcloud,
+        get_image_cache,
+        get_layout_cache,
+        layout_wordcloud,
+        render_wordcloud_to_bytes,
+        tokenize_file_cached,
+        tokenize_japanese_cached,
+        tokenize_japanese_dedup_cached,
+    )
+
+    settings = request["settings"]
+    output_options = request["output_options"]
+    layout_cache = get_layout_cache()
+    # 各段階（解析・配置・色付け・エンコード）の所要時間を記録する
+    with trace() as spans:
+        dedup_stats = None
+        # 色の設定だけが変わった場合は、このセッションの前回の配置をそのまま使う
+        layout = request["session_layout"] or layout_cache.get(request["layout_key"])
+        if layout is None:
+            job.report(0.1, "テキストを解析しています")
+            frequencies = None
+            if request["file_bytes"] is not None:
+                binary = io.BytesIO(request["file_bytes"])
+                binary.name = request["file_name"]
+                frequencies = tokenize_file_cached(
+                    binary, settings["selected_pos"], request["exclude_words"], request["priority_nouns"],
+                    content_digest=request["content_digest"], normalize=settings["normalize_text"],
+                )
+            elif request["dedup_sentences"]:
+                frequencies, dedup_stats = tokenize_japanese_dedup_cached(
+                    request["text"], settings["selected_pos"], request["exclude_words"],
+                    request["priority_nouns"], settings["normalize_text"],
+                )
+            else:
+                frequencies = tokenize_japanese_cached(
+                    request["text"], settings["selected_pos"], request["exclude_words"],
+                    request["priority_nouns"], settings["normalize_text"],
+                )
+            job.report(0.4, "単語を配置しています")
+            layout = layout_wordcloud(
+                request["text"],
+                settings["width"],
+                settings["height"],
+                request["font_path"],
+                settings["selected_pos"],
+                request["exclude_words"],
+                priority_nouns=request["priority_nouns"],
+                max_words=settings["max_words"],
+                collocations=request["collocations"],
+                min_font_size=settings["min_font_size"],
+                is_horizontal_only=settings["is_horizontal_only"],
+                frequencies=frequencies,
+                random_state=settings["seed"],
+                layout_scale=request["layout_scale"],
+                normalize=settings["normalize_text"],
+                mask_bytes=request["mask_bytes"],
+                mask_digest=request["mask_digest"],
+                check_cancelled=job.check_cancelled,
+            )
+            layout_cache.put(request["layout_key"], layout)
+
+        job.report(0.8, "色を付けています")
+        wordcloud = color_wordcloud(
+            layout,
+            settings["background_color"],
+            settings["colormap"],
+            settings["check_contrast"],
+            settings["seed"],
+            settings["contour_width"],
+            settings["contour_color"],
+        )
+        job.report(0.9, "画像を書き出しています")
+        data = render_wordcloud_to_bytes(
+            wordcloud,
+            output_options["image_format"],
+            compress_level=output_options["png_compress_level"],
+            quality=output_options["quality"],
+        )
+        image_ref = get_image_store().put(data)
+        get_image_cache().put(request["image_key"], image_ref)
+    return {
+        "image_ref": image_ref,
+        "layout": layout,
+        "dedup_stats": dedup_stats,
+        "spans": [sp.to_dict() for sp in spans],
+    }
+
 
-    def repl(m):
-        w = m.group(0)
-        ph = word_to_ph[w]
-        return f" {ph} "  # 空白で分離
+def show_generation_result(result, meta):
+    """
+    生成結果をセッションに記録して表示する。
+    """
+    if result["layout"] is not None:
+        st.session_state.last_layout = result["layout"]
+        st.session_state.last_layout_key = meta["layout_key"]
+    st.session_state.last_spans = result["spans"]
+
+    st.session_state.last_image_ref = result["image_ref"]
+    st.session_state.last_full_image_ref = None
+    st.session_state.last_image_format = meta["output_options"]["image_format"]
+    st.session_state.last_settings = meta["settings"]
+    # 原寸での書き出し用
+    st.session_state.last_export_layout_key = meta["layout_key"]
+    st.session_state.last_layout_scale = meta["layout_scale"]
+    st.session_state.last_output_options = meta["output_options"]
+
+    data = get_image_store().get(result["image_ref"])
+    if data is None:
+        st.info("画像の保存期限が切れました。もう一度「ワードクラウドを生成」を押してください。")
+        return
+    st.image(data)
+    mark_milestone("first_cloud")
+    if meta["layout_scale"] > 1:
+        st.caption(
+            f"プレビュー（1/{meta['layout_scale']}に縮小して表示しています）。"
+            f"ダウンロード時は {meta['settings']['width']}×{meta['settings']['height']} の原寸で出力します。"
+        )
 
-    replaced = pattern.sub(repl, text)
-    return replaced, ph_to_word
+    dedup_stats = result["dedup_stats"]
+    if dedup_stats:
+        st.caption(
+            f"重複する文をまとめて解析しました: "
+            f"{dedup_stats['sentences']:,}文中 {dedup_stats['unique_sentences']:,}文を解析"
+            f"（解析した文字数 {dedup_stats['tokenized_chars']:,} / {dedup_stats['chars']:,}、"
+            f"{dedup_stats['saved_ratio']:.0%} 削減）"
+        )
 
-def tokenize_japanese(text, selected_pos, exclude_words=None, priority_nouns=None):
-    tokenizer = Tokenizer()
-    exclude_words = exclude_words or []
-    priority_nouns = priority_nouns or []
+    if SHOW_SPANS and st.session_state.last_spans:
+        with st.expander("処理時間の内訳（デバッグ）", expanded=False):
+            st.table(spans_table(st.session_state.last_spans))
 
-    # 名詞リストを最優先で1語化
-    text_for_tokenize, ph_to_word = apply_priority_nouns(text, priority_nouns)
 
-    tokens = tokenizer.tokenize(text_for_tokenize)
+def job_progress(job_id):
+    """
+    実行中のジョブの進捗とキャンセルボタン。終わっていればページ全体を再実行して結果を表示する。
+    """
+    job = get_job_manager().get(job_id)
+    if job is None or job.done:
+        st.rerun()
+    st.progress(job.progress, text=job.message)
+    if st.button("キャンセル", key="wc_cancel_job"):
+        # 同じ設定で待っている別のセッションがあれば、ジョブ自体はそのまま続く
+        get_job_manager().cancel(job_id, st.session_state["session_id"])
+        st.session_state["job_id"] = None
+        st.session_state["flash"] = "生成をキャンセルしました"
+        st.rerun()
 
-    words = []
-    for token in tokens:
-        surface = token.surface
 
-        # 置換したプレースホルダは「名詞」として扱う
-        if surface in ph_to_word:
-            word = ph_to_word[surface]
-            pos_major = '名詞'
-        else:
-            # Janomeのbase_formが'*'の場合はsurfaceを使う
-            base = token.base_form
-            word = base if base != '*' else surface
-            pos_major = token.part_of_speech.split(',')[0]
-
-        if pos_major in selected_pos and word not in exclude_words and len(word) > 1:
-            words.append(word)
-
-    return ' '.join(words)
-
-def generate_wordcloud(
-    text,
-    width,
-    height,
-    background_color,
-    font_path,
-    selected_pos,
-    exclude_words=None,
-    priority_nouns=None,
-    max_words=50,
-    collocations=False,
-    min_font_size=10,
-    colormap=None,
-    is_horizontal_only=True,
-    check_contrast=True
-):
-    horizontal = 1.0 if is_horizontal_only else 0.5
-    words = tokenize_japanese(text, selected_pos, exclude_words, priority_nouns)
-
-    # デバッグ用出力
-    print("トークナイズ後の単語列:", words)
-
-    color_func = None
-
-    if check_contrast:
-         # --- コントラスト調整用のカラー関数定義 ---
-         def color_func_with_contrast(word, font_size, position, orientation, random_state=None, **kwargs):
-             # 1. 選択されたカラーマップを取得
-             try:
-                 cmap = matplotlib.colormaps[colormap]
-             except (KeyError, ValueError):
-                 cmap = matplotlib.colormaps["viridis"]  # エラー時のフォールバック
-             
-             # 2. 背景色の明るさを計算 (0:黒 ～ 255:白)
-             bg_rgb = [int(background_color[i:i+2], 16) for i in (1, 3, 5)]
-             bg_luminance = (0.299 * bg_rgb[0] + 0.587 * bg_rgb[1] + 0.114 * bg_rgb[2])
-             
-             # 3. 背景色と被らない色が見つかるまで試行
-             for _ in range(10):  # 無限ループ防止のため最大10回
-                 color = cmap(np.random.uniform(0, 1))
-                 # RGB (0-1) を 0-255 に変換
-                 r, g, b = [int(c * 255) for c in color[:3]]
-                 word_luminance = (0.299 * r + 0.587 * g + 0.114 * b)
-                 # 背景が明るい場合：明るすぎる文字色(輝度180以上)を避ける
-                 if bg_luminance > 128:
-                     if word_luminance < 180: 
-                         return f"rgb({r}, {g}, {b})"
-                 # 背景が暗い場合：暗すぎる文字色(輝度80以下)を避ける
-                 else:
-                     if word_luminance > 80:
-                         return f"rgb({r}, {g}, {b})"
-             # 適切な色が見つからなかった場合のフォールバック
-             return f"rgb({r}, {g}, {b})"
-
-         color_func = color_func_with_contrast
-     
-    # --- ワードクラウドの生成 ---
-    wordcloud = WordCloud(
-        font_path=font_path,
-        width=width,
-        height=height,
-        background_color=background_color,
-        max_words=max_words,
-        min_font_size=min_font_size,
-        collocations=collocations,
-        colormap=colormap if not color_func else None,
-        color_func=color_func,
-        prefer_horizontal=horizontal,
-    ).generate(words)
-
-    return wordcloud
-
-def render_wordcloud_to_png_bytes(wordcloud):
-    fig, ax = plt.subplots(figsize=(10, 5))
-    ax.imshow(wordcloud, interpolation="bilinear")
-    ax.axis("off")
-
-    buf = io.BytesIO()
-    fig.savefig(buf, format="png", bbox_inches="tight")
-    buf.seek(0)
-    return buf.getvalue()
+if HAS_FRAGMENT:
+    # 進捗の部分だけを定期的に再実行する（ページ全体は再実行しない）
+    job_progress = st.fragment(run_every=JOB_POLL_INTERVAL)(job_progress)
 
 
 # =========================================================
@@ -418,29 +598,70 @@ if st.session_state.get("flash"):
     st.success(st.session_state["flash"])
     st.session_state["flash"] = None
 
-# ユーザーからのテキスト入力
-user_input = st.text_area(
-    "テキストを入力してください",
-    key="wc_text"
+# 入力方法
+input_mode = st.radio(
+    "入力方法",
+    ["テキスト入力", "ファイルをアップロード"],
+    horizontal=True,
+    key="wc_input_mode"
+)
+
+uploaded_file = None
+user_input = ""
+if input_mode == "ファイルをアップロード":
+    # 大きなファイルは文末で区切ったチャンクごとに解析する
+    uploaded_file = st.file_uploader(
+        "テキストファイルを選択してください（.txt / .csv、UTF-8またはShift_JIS）",
+        type=["txt", "csv"],
+        key="wc_upload"
+    )
+else:
+    # ユーザーからのテキスト入力
+    user_input = st.text_area(
+        "テキストを入力してください",
+        key="wc_text"
+    )
+
+# 同じ文の繰り返しを1回だけ解析する
+dedup_sentences = st.checkbox(
+    "重複する文をまとめて解析（SNSの投稿など同じ文が何度も出てくる場合に高速化）",
+    value=False,
+    key="wc_dedup_sentences"
 )
 
 # 名詞リスト
 priority_nouns_input = st.text_input(
     "名詞として優先したい単語を入力してください（カンマ区切り）",
-    value="北海道文化放送,中道改革連合,日本維新の会,国民民主党,れいわ新選組,参政党,日本保守党,チームみらい",
+    value=DEFAULT_SETTINGS["priority_nouns_input"],
     key="wc_priority_nouns_input"
 )
-priority_nouns = [w.strip() for w in priority_nouns_input.split(',') if w.strip()]
+priority_nouns = split_comma_list(priority_nouns_input)
 
 # 除外する単語の入力
 exclude_input = st.text_input(
     "除外する単語を入力してください（カンマ区切り）",
-    value="https,的, こと, もの, それ, これ, ため, よう, そこ, どこ, とき, あと, みたい, ような",
+    value=DEFAULT_SETTINGS["exclude_input"],
     key="wc_exclude_input"
 )
 
+# 同梱の日本語のよく使われる語（これ・それ・こと など）も除外する
+use_default_stopwords = st.checkbox(
+    "よく使われる語（これ・それ・こと など）を除外",
+    value=DEFAULT_SETTINGS["use_default_stopwords"],
+    key="wc_use_default_stopwords"
+)
+
+# 全角・半角などの表記ゆれをそろえる
+normalize_text = st.checkbox(
+    "全角・半角の表記をそろえる（ＡＢＣ→ABC、ｶﾀｶﾅ→カタカナ など）",
+    value=DEFAULT_SETTINGS["normalize_text"],
+    key="wc_normalize_text"
+)
+
 # 除外単語をリストに変換
-exclude_words = [word.strip() for word in exclude_input.split(',') if word.strip()]
+exclude_words = split_comma_list(exclude_input)
+if use_default_stopwords:
+    exclude_words += get_default_japanese_stopwords()
 
 # 品詞のオプション
 pos_options = [
@@ -468,8 +689,8 @@ selected_pos = st.multiselect(
 # 表示する単語数の上限
 max_words = st.number_input(
     "表示する最大単語数",
-    min_value=5,
-    max_value=200,
+    min_value=SETTING_RANGES["max_words"][0],
+    max_value=SETTING_RANGES["max_words"][1],
     value=20,
     step=1,
     key="wc_max_words"
@@ -478,8 +699,8 @@ max_words = st.number_input(
 # 最小フォントサイズ
 min_font_size = st.number_input(
     "最小フォントサイズ",
-    min_value=1,
-    max_value=200,
+    min_value=SETTING_RANGES["min_font_size"][0],
+    max_value=SETTING_RANGES["min_font_size"][1],
     value=10,
     step=1,
     key="wc_min_font_size"
@@ -488,8 +709,8 @@ min_font_size = st.number_input(
 # ワードクラウド画像の幅入力
 width = st.number_input(
     "ワードクラウドの幅",
-    min_value=100,
-    max_value=4000,
+    min_value=SETTING_RANGES["width"][0],
+    max_value=SETTING_RANGES["width"][1],
     value=800,
     step=1,
     key="wc_width"
@@ -498,13 +719,20 @@ width = st.number_input(
 # ワードクラウド画像の高さ入力
 height = st.number_input(
     "ワードクラウドの高さ",
-    min_value=100,
-    max_value=4000,
+    min_value=SETTING_RANGES["height"][0],
+    max_value=SETTING_RANGES["height"][1],
     value=600,
     step=1,
     key="wc_height"
 )
 
+# 大きなサイズは縮小して配置・表示し、ダウンロード時だけ原寸で描画する
+preview_mode = st.checkbox(
+    f"プレビューモード（幅・高さが{PREVIEW_MAX_SIDE}pxを超える場合は縮小して表示し、ダウンロード時に原寸で出力）",
+    value=True,
+    key="wc_preview_mode"
+)
+
 # 横書きの制御
 is_horizontal_only = st.checkbox(
     "横書きのみ",
@@ -514,6 +742,27 @@ is_horizontal_only = st.checkbox(
 # 内部的にはcollocationsは常にFalseに設定（重複防止）
 collocations = False
 
+# マスク画像（ロゴなど）の形に沿って配置する
+mask_file = st.file_uploader(
+    "形に沿って配置するマスク画像（任意。暗い部分に単語を置き、白・透明な部分には置きません）",
+    type=["png", "jpg", "jpeg", "webp"],
+    key="wc_mask_file"
+)
+contour_width = st.number_input(
+    "マスクの輪郭線の太さ（0で描かない）",
+    min_value=SETTING_RANGES["contour_width"][0],
+    max_value=SETTING_RANGES["contour_width"][1],
+    value=DEFAULT_SETTINGS["contour_width"],
+    step=1,
+    key="wc_contour_width",
+    disabled=mask_file is None
+)
+contour_color = st.color_picker(
+    "輪郭線の色", DEFAULT_SETTINGS["contour_color"],
+    key="wc_contour_color",
+    disabled=mask_file is None
+)
+
 # 背景色の選択
 background_color = st.color_picker(
     "背景色を選択", "#f4f5f7",
@@ -556,53 +805,80 @@ colormap = st.selectbox(
     key="wc_colormap"
 )
 
+# 出力形式
+image_format = st.selectbox(
+    "画像の形式",
+    list(IMAGE_FORMATS),
+    key="wc_image_format"
+)
+if image_format == "PNG":
+    # 数字が大きいほどファイルは小さくなるが、保存に時間がかかる
+    png_compress_level = st.slider(
+        "PNGの圧縮レベル",
+        min_value=OUTPUT_OPTION_RANGES["png_compress_level"][0],
+        max_value=OUTPUT_OPTION_RANGES["png_compress_level"][1],
+        value=6,
+        key="wc_png_compress_level"
+    )
+    image_quality = 90
+else:
+    png_compress_level = 6
+    image_quality = st.slider(
+        "画質",
+        min_value=OUTPUT_OPTION_RANGES["quality"][0],
+        max_value=OUTPUT_OPTION_RANGES["quality"][1],
+        value=90,
+        key="wc_image_quality"
+    )
+output_options = {
+    "image_format": image_format,
+    "png_compress_level": int(png_compress_level),
+    "quality": int(image_quality),
+}
+
 # フォントファイルのパス指定
 # font_path = "./Streamlit/NotoSansJP-VariableFont_wght.ttf" # Noto Sans JP Thin
 font_path = "./Streamlit/GenSekiGothic2JP-B.otf" # 源石ゴシックB
 
 
+# 生成ジョブの完了を待っている間、ページ全体を再実行して確認するか（st.fragment が無い場合）
+poll_job = False
+
 # フォントファイルの存在確認
 if not os.path.exists(font_path):
     st.error(
         f"指定されたフォントが見つかりません。フォントパスを確認してください: {font_path}"
     )
 else:
+    jobs = get_job_manager()
+    session_id = st.session_state["session_id"]
+
     # ワードクラウド生成ボタンがクリックされたとき
     if st.button("ワードクラウドを生成"):
-        if not user_input:
+        if not user_input and uploaded_file is None:
             st.error("ワードクラウドを生成するテキストを入力してください。")
         elif not selected_pos:
             st.error("少なくとも1つの品詞を選択してください。")
         else:
             try:
+                from wordcloud_core import (
+                    get_image_cache,
+                    hash_stream,
+                    hash_text,
+                    make_image_cache_key,
+                )
+
                 seed = st.session_state.get("wc_seed")
                 if seed is None:
                     seed = secrets.randbelow(2**31 - 1)
                 st.session_state["wc_seed"] = seed
-                wordcloud = generate_wordcloud(
-                    user_input, 
-                    width, 
-                    height, 
-                    background_color,
-                    font_path, 
-                    selected_pos, 
-                    exclude_words, 
-                    priority_nouns=priority_nouns,
-                    max_words=max_words, 
-                    collocations=collocations, 
-                    min_font_size=min_font_size, 
-                    colormap=colormap,
-                    is_horizontal_only=is_horizontal_only,
-                    check_contrast=check_contrast,
-                )
-
-                png_bytes = render_wordcloud_to_png_bytes(wordcloud)
-                st.session_state.last_png = png_bytes
 
-                # 保存用に設定を保持
-                st.session_state.last_settings = {
+                # 保存用の設定（画像キャッシュのキーにも使う）
+                settings = {
                     "priority_nouns_input": priority_nouns_input, # オリジナル名詞
                     "exclude_input": exclude_input, # 除外する単語
+                    "use_default_stopwords": bool(use_default_stopwords), # よく使われる語を除外
+                    "normalize_text": bool(normalize_text), # 全角・半角をそろえる
                     "selected_pos": list(selected_pos), # 含める品詞
                     "max_words": int(max_words), # 表示する最大単語数
                     "min_font_size": int(min_font_size), # 最小フォントサイズ
@@ -612,24 +888,130 @@ else:
                     "background_color": background_color, # 背景色
                     "check_contrast": bool(check_contrast), # コントラスト調整
                     "colormap": colormap, # カラーマップ
+                    "contour_width": int(contour_width), # マスクの輪郭線の太さ
+                    "contour_color": contour_color, # 輪郭線の色
+                    "seed": int(seed), # 乱数シード（配置・配色の再現用）
                 }
 
-                st.image(png_bytes)
+                if uploaded_file is not None:
+                    content_digest = hash_stream(uploaded_file)
+                else:
+                    content_digest = hash_text(user_input)
+                # マスク画像は設定（cookie）には保存せず、ハッシュだけをキャッシュのキーに使う
+                mask_bytes = mask_file.getvalue() if mask_file is not None else None
+                mask_digest = hashlib.sha256(mask_bytes).hexdigest() if mask_bytes else None
+                layout_scale = preview_scale_for(width, height) if preview_mode else 1
+                layout_settings = {k: v for k, v in settings.items() if k not in COLOR_SETTING_KEYS}
+                layout_key = make_image_cache_key(
+                    content_digest, layout_settings, font_path, {"layout_scale": layout_scale, "mask": mask_digest}
+                )
+                image_key = make_image_cache_key(
+                    content_digest,
+                    settings,
+                    font_path,
+                    {**output_options, "layout_scale": layout_scale, "mask": mask_digest},
+                )
+                meta = {
+                    "settings": settings,
+                    "layout_key": layout_key,
+                    "layout_scale": layout_scale,
+                    "output_options": output_options,
+                }
+
+                # 同じ画像を作ったことがあれば、ジョブにせずにそのまま表示する
+                with trace() as spans:
+                    image_ref = get_image_cache().get(image_key)
+                    cached = get_image_store().get(image_ref) is not None
+                previous = jobs.get(st.session_state.get("job_id"))
+                if cached:
+                    if previous is not None:
+                        jobs.cancel(previous.id, session_id)
+                    st.session_state.job_id = None
+                    result = {
+                        "image_ref": image_ref,
+                        "layout": None,
+                        "dedup_stats": None,
+                        "spans": [sp.to_dict() for sp in spans],
+                    }
+                    show_generation_result(result, meta)
+                else:
+                    # ワーカースレッドに渡すので、アップロードファイルは中身のコピーを渡す
+                    request = {
+                        **meta,
+                        "text": user_input,
+                        "file_bytes": uploaded_file.getvalue() if uploaded_file is not None else None,
+                        "file_name": uploaded_file.name if uploaded_file is not None else "",
+                        "content_digest": content_digest,
+                        "exclude_words": list(exclude_words),
+                        "priority_nouns": list(priority_nouns),
+                        "dedup_sentences": bool(dedup_sentences),
+                        "collocations": collocations,
+                        "font_path": font_path,
+                        "mask_bytes": mask_bytes,
+                        "mask_digest": mask_digest,
+                        "image_key": image_key,
+                        "session_layout": (
+                            st.session_state.get("last_layout")
+                            if st.session_state.get("last_layout_key") == layout_key else None
+                        ),
+                    }
+                    # 同じ設定のジョブが実行中ならそれを待つ（二重クリック・複数タブで二重に生成しない）
+                    job = jobs.submit(image_key, functools.partial(run_generation, request=request), session_id)
+                    if previous is not None and previous.id != job.id:
+                        # 前の設定のジョブはもう待たない
+                        jobs.cancel(previous.id, session_id)
+                    st.session_state.job_id = job.id
+                    st.session_state.job_meta = meta
 
             except Exception as e:
                 st.error(f"エラーが発生しました: {e}")
 
+    # 生成ジョブの進捗・結果
+    if st.session_state.get("job_id"):
+        job = jobs.get(st.session_state["job_id"])
+        if job is None:
+            # 結果の保存期限が切れた
+            st.session_state.job_id = None
+        elif job.done:
+            st.session_state.job_id = None
+            if job.status == DONE:
+                show_generation_result(job.result, st.session_state.job_meta)
+            elif job.status == FAILED:
+                st.error(f"エラーが発生しました: {job.error}")
+            else:
+                st.info("生成をキャンセルしました")
+        else:
+            job_progress(job.id)
+            poll_job = not HAS_FRAGMENT
+
     # 画像生成後だけ表示
-    if st.session_state.get("last_png") and st.session_state.get("last_settings"):
+    if st.session_state.get("last_image_ref") and st.session_state.get("last_settings"):
         c1, c2 = st.columns([1, 1])
 
         with c1:
-            st.download_button(
-                label="画像をダウンロード",
-                data=st.session_state.get("last_png"),
-                file_name="wordcloud.png",
-                mime="image/png",
-            )
+            _, ext, mime = IMAGE_FORMATS[st.session_state.get("last_image_format") or "PNG"]
+            if st.session_state.get("last_layout_scale", 1) > 1 and not st.session_state.get("last_full_image_ref"):
+                # プレビューモード：ボタンが押されたときだけ原寸で描画する
+                if st.button("原寸の画像を作成"):
+                    try:
+                        with st.spinner("原寸の画像を作成しています..."):
+                            st.session_state.last_full_image_ref = export_full_resolution()
+                    except Exception as e:
+                        st.error(f"原寸の画像を作成できませんでした: {e}")
+            else:
+                data = get_image_store().get(
+                    st.session_state.get("last_full_image_ref") or st.session_state.get("last_image_ref")
+                )
+                if data is None:
+                    # 長い間使われなかった画像は消えている
+                    st.info("画像の保存期限が切れました。もう一度「ワードクラウドを生成」を押してください。")
+                else:
+                    st.download_button(
+                        label="画像をダウンロード",
+                        data=data,
+                        file_name=f"wordcloud.{ext}",
+                        mime=mime,
+                    )
 
         with c2:
             if st.button("入力内容を保存", type="primary"):
@@ -638,16 +1020,20 @@ else:
                     default_name = make_default_name(history)
 
                     item = {
-                        "id": str(uuid.uuid4()),
+                        "id": uuid.uuid4().hex[:12],
                         "created_at": _now_iso_jst(),
                         "name": default_name,
                         "settings": st.session_state["last_settings"],
                     }
                     history.append(item)
-                    history = history[-MAX_HISTORY:]
-                    save_history(history)
-
-                    st.session_state["flash"] = "設定を保存しました（cookieに保存）"
+                    saved = save_history(history)
+
+                    message = "設定を保存しました（cookieに保存）"
+                    # 件数・容量の上限で古い設定を削った場合は、その件数を知らせる
+                    removed = len(history) - len(saved)
+                    if removed:
+                        message += f"。上限を超えたため、古い設定を{removed}件削除しました"
+                    st.session_state["flash"] = message
                     st.rerun()
                 except Exception as e:
                     st.error(f"保存に失敗しました: {e}")
@@ -660,52 +1046,68 @@ st.divider()
 st.caption("保存した設定（ブラウザcookieに保存）")
 
 with st.expander("保存した設定", expanded=False):
-    history = load_history()
+    if not COOKIES_READY:
+        st.caption("保存した設定を読み込んでいます...")
+    else:
+        history = load_history()
+
+        # リセット
+        if st.button("履歴のリセット", type="secondary", key="reset_btn"):
+            if HAS_DIALOG:
+                reset_dialog()
+            else:
+                # フォールバック（dialog無いなら即リセット or 画面内確認に変えてOK）
+                reset_history()
+                st.session_state["flash"] = "保存をリセットしました"
+                st.rerun()
 
-    # リセット
-    if st.button("履歴のリセット", type="secondary", key="reset_btn"):
-        if HAS_DIALOG:
-            reset_dialog()
+        if not history:
+            st.caption("保存履歴はまだありません。")
         else:
-            # フォールバック（dialog無いなら即リセット or 画面内確認に変えてOK）
-            reset_history()
-            st.session_state["flash"] = "保存をリセットしました"
-            st.rerun()
-
-    if not history:
-        st.caption("保存履歴はまだありません。")
-    else:
-        # 新しい順に表示
-        for item in reversed(history):
-            item_id = item.get("id")
-            name = item.get("name", "（無名）")
-            created_at = item.get("created_at", "")
-            settings = item.get("settings", {}) or {}
-
-            with st.container(border=True):
-                st.markdown(f"**{name}**")
-                st.caption(f"保存日時: {created_at}")
-
-                b1, b2, b3 = st.columns([1, 1, 3])
-
-                with b1:
-                    if st.button("読み込み", key=f"load_{item_id}"):
-                        st.session_state["pending_load_settings"] = settings
-                        st.session_state["pending_load_name"] = name
-                        st.rerun()
-
-                with b2:
-                    if st.button("名前を編集", key=f"rename_{item_id}"):
-                        if HAS_DIALOG:
-                            rename_dialog(item_id, name)
-                        else:
-                            st.warning("この環境では使えません")
-
-                with b3:
-                    if st.button("削除", key=f"delete_{item_id}"):
-                        if HAS_DIALOG:
-                            delete_dialog(item_id, name)
-                        else:
-                            delete_history_item(item_id)
-                            st.session_state["flash"] = "削除しました"
+            # 新しい順に表示
+            for item in reversed(history):
+                item_id = item.get("id")
+                name = item.get("name", "（無名）")
+                created_at = item.get("created_at", "")
+                settings = item.get("settings", {}) or {}
+
+                with st.container(border=True):
+                    st.markdown(f"**{name}**")
+                    st.caption(f"保存日時: {created_at}")
+
+                    b1, b2, b3 = st.columns([1, 1, 3])
+
+                    with b1:
+                        if st.button("読み込み", key=f"load_{item_id}"):
+                            st.session_state["pending_load_settings"] = settings
+                            st.session_state["pending_load_name"] = name
                             st.rerun()
+
+                    with b2:
+                        if st.button("名前を編集", key=f"rename_{item_id}"):
+                            if HAS_DIALOG:
+                                rename_dialog(item_id, name)
+                            else:
+                                st.warning("この環境では使えません")
+
+                    with b3:
+                        if st.button("削除", key=f"delete_{item_id}"):
+                            if HAS_DIALOG:
+                                delete_dialog(item_id, name)
+                            else:
+                                delete_history_item(item_id)
+                                st.session_state["flash"] = "削除しました"
+                                st.rerun()
+
+
+# =========================================================
+# 起動時間の計測とバックグラウンドでの準備
+# =========================================================
+# このプロセスで最初にページを最後まで表示した時点（サーバー側で計測）
+mark_milestone("first_paint")
+start_background_warmup(font_path)
+
+# st.fragment が無い古いStreamlitでは、ページ全体を再実行して進捗を確認する
+if poll_job:
+    time.sleep(JOB_POLL_INTERVAL)
+    st.rerun()
@@ -0,0 +1,540 @@
+"""
+ワードクラウド生成の各段階のベンチマーク。
+
+使い方:
+    python Streamlit/wordcloud_bench.py --output bench.json
+    python Streamlit/wordcloud_bench.py --quick                    # 小さい入力だけで一通り
+    python Streamlit/wordcloud_bench.py --only tokenize --max-size 1MB
+    python Streamlit/wordcloud_bench.py --fixture corpus.txt       # 手元のコーパスも測る
+    python Streamlit/wordcloud_bench.py --compare old.json --output new.json
+    python Streamlit/wordcloud_bench.py --only backends --max-size 1MB   # 形態素解析エンジンの比較
+
+結果はJSON（meta と results のリスト）で出力する。--compare を付けると、
+前回の結果と同じ (stage, params) の中央値を比べた表を標準エラーに出す。
+backends はこの環境で使えるエンジンごとの速度と、Janomeと集計結果が一致するか（parity）を測る。
+word_counts は単語の数え方が WordCloud.process_text() と一致するかを確かめる。
+file_chunks はファイルをチャンクごとに読んで解析した結果が、テキスト全体を解析した結果と一致するかを確かめる。
+parallel は並列解析（ワーカープロセスに分けて解析）の結果が、直列で解析した結果と一致するかを確かめる。
+一致しないものがあれば終了コード 1 を返す。
+"""
+import io
+import os
+import gc
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import statistics
+import subprocess
+from datetime import datetime, timezone
+
+import morphology
+from morphology import apply_priority_nouns, count_words, iter_japanese_words, tokenize_japanese
+from wordcloud_core import (
+    get_contrast_palette,
+    layout_wordcloud,
+    color_wordcloud,
+    make_contrast_color_func,
+    render_wordcloud_to_png_bytes,
+)
+from wordcloud_settings import DEFAULT_FONT_PATH
+
+KB = 1024
+MB = 1024 * KB
+CORPUS_SIZES = [1 * KB, 100 * KB, 1 * MB, 10 * MB, 50 * MB]
+PRIORITY_NOUN_COUNTS = [10, 100, 1000, 10000]
+PRIORITY_NOUN_CORPUS_SIZE = 1 * MB
+POS_SELECTIONS = [["名詞"], ["名詞", "動詞"], ["名詞", "動詞", "形容詞"]]
+CANVAS_SIZES = [(800, 600), (1600, 1200), (4000, 4000)]
+LAYOUT_MAX_WORDS = 200
+LAYOUT_CORPUS_SIZE = 100 * KB
+COLOR_FUNC_CALLS = 100000
+QUICK_MAX_SIZE = 100 * KB
+# 記号を含む優先名詞（\wの並びに分割されて1文字の語が残る）
+SYMBOL_PRIORITY_NOUNS = ["C++", "C#", "e-Tax", "J-POP"]
+WORD_COUNT_PARITY_MAX_SIZE = 100 * KB
+# ファイルの読み込みを細かいチャンクに分けて、区切り目を多く通るようにする
+FILE_CHUNK_CHARS = 4 * KB
+FILE_PARITY_MAX_SIZE = 1 * MB
+PARALLEL_PARITY_MAX_SIZE = 1 * MB
+
+
+# =========================================================
+# 合成コーパス
+# =========================================================
+NOUNS = (
+    "東京 大阪 京都 北海道 沖縄 会議 政府 経済 社会 文化 教育 研究 技術 環境 地域 市場 企業 "
+    "国民 選挙 議会 予算 政策 改革 制度 情報 番組 放送 記者 取材 報道 写真 映像 音楽 映画 "
+    "学校 大学 学生 先生 病院 医療 福祉 家族 子ども 高齢者 仕事 会社 社員 価格 物価 賃金 "
+    "天気 台風 地震 災害 避難 電車 道路 空港 観光 旅行 料理 野菜 果物 商品 店舗 利用者 "
+    "データ システム サービス アプリ ネット スマホ 計画 結果 問題 課題 意見 議論 発表 調査"
+).split()
+VERBS = "行う 進める 考える 話す 決める 始める 続ける 増える 減る 変わる 見る 作る 使う 集まる 示す".split()
+ADJECTIVES = "新しい 大きい 小さい 多い 少ない 高い 安い 早い 難しい 良い".split()
+SENTENCE_TEMPLATES = (
+    "{n1}の{n2}が{v}。",
+    "{a}{n1}について{n2}で{v}。",
+    "{n1}{n2}は{a}と{n3}が{v}。",
+    "昨日、{n1}と{n2}の{n3}を{v}予定だ。",
+    "{n1}では{a}{n2}が話題になった。",
+)
+
+
+def synthetic_corpus(size_bytes, seed=0):
+    """
+    UTF-8でおよそ size_bytes になる日本語の文章を決まった乱数で作る。
+    """
+    rng = random.Random(seed)
+    parts = []
+    total = 0
+    while total < size_bytes:
+        sentence = rng.choice(SENTENCE_TEMPLATES).format(
+            n1=rng.choice(NOUNS),
+            n2=rng.choice(NOUNS),
+            n3=rng.choice(NOUNS),
+            v=rng.choice(VERBS),
+            a=rng.choice(ADJECTIVES),
+        )
+        if rng.random() < 0.1:
+            sentence += "\n"
+        parts.append(sentence)
+        total += len(sentence.encode("utf-8"))
+    return "".join(parts)
+
+
+def synthetic_priority_nouns(count, seed=0):
+    """
+    合成コーパスに出てくる「名詞＋名詞」の組み合わせから count 個の優先語を作る。
+    """
+    rng = random.Random(seed)
+    pairs = [a + b for a in NOUNS for b in NOUNS if a != b]
+    rng.shuffle(pairs)
+    terms = pairs[:count]
+    # 組み合わせが足りない分は3語の連結で補う
+    while len(terms) < count:
+        terms.append(rng.choice(NOUNS) + rng.choice(NOUNS) + rng.choice(NOUNS) + str(len(terms)))
+    return terms
+
+
+def load_fixture(path):
+    with open(path, "rb") as f, morphology.open_text_stream(f) as stream:
+        return stream.read()
+
+
+def format_size(size_bytes):
+    if size_bytes >= MB:
+        return f"{size_bytes / MB:g}MB"
+    if size_bytes >= KB:
+        return f"{size_bytes / KB:g}KB"
+    return f"{size_bytes}B"
+
+
+def parse_size(value):
+    value = value.strip().upper()
+    for suffix, unit in (("MB", MB), ("KB", KB), ("B", 1)):
+        if value.endswith(suffix):
+            return int(float(value[: -len(suffix)]) * unit)
+    return int(value)
+
+
+# =========================================================
+# 計測
+# =========================================================
+def measure(fn, repeat):
+    """
+    fn() を repeat 回実行して、1回ごとの秒数のリストと最後の戻り値を返す。
+    """
+    timings = []
+    result = None
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return timings, result
+
+
+def make_result(stage, params, timings, input_bytes=None, items=None):
+    median = statistics.median(timings)
+    result = {
+        "stage": stage,
+        "params": params,
+        "repeat": len(timings),
+        "min_s": min(timings),
+        "median_s": median,
+        "mean_s": statistics.fmean(timings),
+    }
+    if input_bytes is not None:
+        result["input_bytes"] = input_bytes
+        result["mb_per_s"] = input_bytes / MB / median if median else None
+    if items is not None:
+        result["items"] = items
+        result["items_per_s"] = items / median if median else None
+    return result
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+class Corpora:
+    """
+    合成コーパスとフィクスチャを名前つきで用意する（同じサイズは1回だけ作る）。
+    """
+
+    def __init__(self, sizes, fixtures):
+        self.sizes = sizes
+        self.fixtures = fixtures
+        self._synthetic = {}
+
+    def synthetic(self, size_bytes):
+        if size_bytes not in self._synthetic:
+            self._synthetic[size_bytes] = synthetic_corpus(size_bytes)
+        return self._synthetic[size_bytes]
+
+    def __iter__(self):
+        for size_bytes in self.sizes:
+            yield f"synthetic-{format_size(size_bytes)}", self.synthetic(size_bytes)
+        for path in self.fixtures:
+            yield os.path.basename(path), load_fixture(path)
+
+
+# =========================================================
+# 各段階
+# =========================================================
+def bench_priority_nouns(ctx):
+    size_bytes = min(PRIORITY_NOUN_CORPUS_SIZE, ctx.max_size)
+    text = ctx.corpora.synthetic(size_bytes)
+    input_bytes = len(text.encode("utf-8"))
+    for count in PRIORITY_NOUN_COUNTS:
+        terms = synthetic_priority_nouns(count)
+        # 照合器の構築と、（キャッシュ済みの照合器での）置換を分けて測る
+        build, _ = measure(lambda: morphology.PriorityNounMatcher(frozenset(terms)), ctx.repeat)
+        timings, _ = measure(lambda: apply_priority_nouns(text, terms), ctx.repeat)
+        yield make_result("priority_nouns_build", {"terms": count}, build, items=count)
+        yield make_result(
+            "priority_nouns", {"terms": count, "corpus": f"synthetic-{format_size(size_bytes)}"},
+            timings, input_bytes=input_bytes,
+        )
+
+
+def bench_tokenize(ctx):
+    morphology.get_tokenizer_pool().warm_up()
+    for name, text in ctx.corpora:
+        input_bytes = len(text.encode("utf-8"))
+        for selected_pos in POS_SELECTIONS:
+            timings, counts = measure(lambda: tokenize_japanese(text, selected_pos), ctx.repeat)
+            yield make_result(
+                "tokenize", {"corpus": name, "pos": "+".join(selected_pos)},
+                timings, input_bytes=input_bytes, items=sum(counts.values()),
+            )
+
+
+def bench_backends(ctx):
+    # Janome を基準にして、ほかのエンジンの集計結果が同じかを確かめる
+    backends = sorted(morphology.available_backends(), key=lambda backend: backend != "janome")
+    if len(backends) < 2:
+        log(f"比べる形態素解析エンジンがありません（使えるもの: {', '.join(backends)}）")
+    for backend in backends:
+        morphology.get_tokenizer_pool(backend).warm_up()
+    priority_nouns = synthetic_priority_nouns(PRIORITY_NOUN_COUNTS[0])
+    for name, text in ctx.corpora:
+        input_bytes = len(text.encode("utf-8"))
+        for selected_pos in POS_SELECTIONS:
+            expected = None
+            for backend in backends:
+                timings, counts = measure(
+                    lambda: tokenize_japanese(text, selected_pos, priority_nouns=priority_nouns, backend=backend),
+                    ctx.repeat,
+                )
+                result = make_result(
+                    "tokenize_backend", {"corpus": name, "pos": "+".join(selected_pos), "backend": backend},
+                    timings, input_bytes=input_bytes, items=sum(counts.values()),
+                )
+                if expected is None:
+                    expected = counts
+                else:
+                    result.update(parity(expected, counts))
+                yield result
+
+
+def parity(expected, actual, limit=20):
+    """
+    2つの 単語→出現回数 を比べる。違う単語は差の大きい順に [単語, 基準, 比べるもの] で最大 limit 件。
+    """
+    diff = [word for word in expected.keys() | actual.keys() if expected.get(word) != actual.get(word)]
+    diff.sort(key=lambda word: (-abs(expected.get(word, 0) - actual.get(word, 0)), word))
+    return {
+        "parity_ok": not diff,
+        "parity_diff_words": len(diff),
+        "parity_diff": [[word, expected.get(word, 0), actual.get(word, 0)] for word in diff[:limit]],
+    }
+
+
+def bench_word_counts(ctx):
+    # count_words() が WordCloud.process_text()（以前の generate() の数え方）と同じ結果になるかを確かめる
+    from wordcloud import WordCloud
+
+    rng = random.Random(0)
+    for size_bytes in [size for size in ctx.corpora.sizes if size <= WORD_COUNT_PARITY_MAX_SIZE]:
+        sentences = [
+            f"{rng.choice(SYMBOL_PRIORITY_NOUNS)}と{rng.choice(SYMBOL_PRIORITY_NOUNS)}の{rng.choice(NOUNS)}を{rng.choice(VERBS)}。"
+            for _ in range(max(1, size_bytes // 200))
+        ]
+        text = ctx.corpora.synthetic(size_bytes) + "".join(sentences)
+        input_bytes = len(text.encode("utf-8"))
+        for selected_pos in POS_SELECTIONS:
+            words = list(iter_japanese_words(text, selected_pos, priority_nouns=SYMBOL_PRIORITY_NOUNS))
+            expected = WordCloud(collocations=False).process_text(" ".join(words))
+            timings, counts = measure(lambda: count_words(words), ctx.repeat)
+            result = make_result(
+                "count_words", {"corpus": f"synthetic-{format_size(size_bytes)}+symbols", "pos": "+".join(selected_pos)},
+                timings, input_bytes=input_bytes, items=len(words),
+            )
+            result.update(parity(expected, counts))
+            yield result
+
+
+def bench_file_chunks(ctx):
+    # ファイル（チャンクごとに読む）とテキスト入力（全体を1回で解析）で集計結果が同じになるかを確かめる
+    morphology.get_tokenizer_pool().warm_up()
+    for size_bytes in [size for size in ctx.corpora.sizes if size <= FILE_PARITY_MAX_SIZE]:
+        name = f"synthetic-{format_size(size_bytes)}"
+        text = ctx.corpora.synthetic(size_bytes)
+        data = text.encode("utf-8")
+        for priority_nouns in ([], SYMBOL_PRIORITY_NOUNS):
+            expected = tokenize_japanese(text, ["名詞"], priority_nouns=priority_nouns)
+
+            def count_file():
+                with morphology.open_text_stream(io.BytesIO(data)) as stream:
+                    chunks = morphology.iter_text_chunks(stream, chunk_chars=FILE_CHUNK_CHARS)
+                    return morphology.count_words_from_chunks(chunks, ["名詞"], priority_nouns=priority_nouns)
+
+            timings, counts = measure(count_file, ctx.repeat)
+            result = make_result(
+                "tokenize_file", {"corpus": name, "priority_nouns": len(priority_nouns)},
+                timings, input_bytes=len(data), items=sum(counts.values()),
+            )
+            result.update(parity(expected, counts))
+            yield result
+
+
+def bench_parallel(ctx):
+    # 並列解析（シャードに分けてワーカープロセスで解析）と直列の解析で集計結果が同じになるかを確かめる
+    morphology.get_tokenizer_pool().warm_up()
+    for size_bytes in [size for size in ctx.corpora.sizes if size <= PARALLEL_PARITY_MAX_SIZE]:
+        text = ctx.corpora.synthetic(size_bytes)
+        for priority_nouns in ([], SYMBOL_PRIORITY_NOUNS):
+            expected = tokenize_japanese(text, ["名詞"], priority_nouns=priority_nouns)
+            timings, counts = measure(
+                lambda: morphology.tokenize_japanese_parallel(text, ["名詞"], priority_nouns=priority_nouns),
+                ctx.repeat,
+            )
+            result = make_result(
+                "tokenize_parallel",
+                {
+                    "corpus": f"synthetic-{format_size(size_bytes)}",
+                    "priority_nouns": len(priority_nouns),
+                    "workers": morphology.PARALLEL_WORKERS,
+                },
+                timings, input_bytes=len(text.encode("utf-8")), items=sum(counts.values()),
+            )
+            result.update(parity(expected, counts))
+            yield result
+
+
+def _layout_frequencies(ctx):
+    if ctx.frequencies is None:
+        text = ctx.corpora.synthetic(LAYOUT_CORPUS_SIZE)
+        ctx.frequencies = tokenize_japanese(text, ["名詞"])
+    return ctx.frequencies
+
+
+def _layout(ctx, width, height):
+    key = (width, height)
+    if key not in ctx.layouts:
+        ctx.layouts[key] = layout_wordcloud(
+            "", width, height, ctx.font_path, ["名詞"],
+            max_words=LAYOUT_MAX_WORDS, frequencies=_layout_frequencies(ctx), random_state=0,
+        )
+    return ctx.layouts[key]
+
+
+def bench_layout(ctx):
+    frequencies = _layout_frequencies(ctx)
+    for width, height in CANVAS_SIZES:
+        timings, wordcloud = measure(
+            lambda: layout_wordcloud(
+                "", width, height, ctx.font_path, ["名詞"],
+                max_words=LAYOUT_MAX_WORDS, frequencies=frequencies, random_state=0,
+            ),
+            ctx.repeat,
+        )
+        ctx.layouts[(width, height)] = wordcloud
+        yield make_result(
+            "layout", {"width": width, "height": height, "max_words": LAYOUT_MAX_WORDS},
+            timings, items=len(wordcloud.layout_),
+        )
+
+
+def bench_color(ctx):
+    for colormap, background_color in (("viridis", "#f4f5f7"), ("viridis", "#101010"), ("Pastel1", "#ffffff")):
+        params = {"colormap": colormap, "background_color": background_color}
+        get_contrast_palette.cache_clear()
+        build, _ = measure(lambda: get_contrast_palette(colormap, background_color), 1)
+        yield make_result("contrast_palette_build", params, build)
+
+        color_func = make_contrast_color_func(colormap, background_color)
+        rng = random.Random(0)
+
+        def call_many():
+            for _ in range(COLOR_FUNC_CALLS):
+                color_func("単語", 20, (0, 0), None, random_state=rng)
+
+        timings, _ = measure(call_many, ctx.repeat)
+        yield make_result("color_func_with_contrast", params, timings, items=COLOR_FUNC_CALLS)
+
+    for width, height in CANVAS_SIZES:
+        wordcloud = _layout(ctx, width, height)
+        timings, _ = measure(lambda: color_wordcloud(wordcloud, "#f4f5f7", "viridis", True, 0), ctx.repeat)
+        yield make_result(
+            "recolor", {"width": width, "height": height}, timings, items=len(wordcloud.layout_),
+        )
+
+
+def bench_render(ctx):
+    for width, height in CANVAS_SIZES:
+        wordcloud = color_wordcloud(_layout(ctx, width, height), "#f4f5f7", "viridis", True, 0)
+        for compress_level in (1, 6):
+            timings, data = measure(
+                lambda: render_wordcloud_to_png_bytes(wordcloud, compress_level=compress_level), ctx.repeat,
+            )
+            result = make_result(
+                "render_png", {"width": width, "height": height, "compress_level": compress_level}, timings,
+            )
+            result["output_bytes"] = len(data)
+            yield result
+
+
+BENCHMARKS = {
+    "priority_nouns": bench_priority_nouns,
+    "tokenize": bench_tokenize,
+    "backends": bench_backends,
+    "word_counts": bench_word_counts,
+    "file_chunks": bench_file_chunks,
+    "parallel": bench_parallel,
+    "layout": bench_layout,
+    "color": bench_color,
+    "render": bench_render,
+}
+
+
+class BenchContext:
+    def __init__(self, corpora, font_path, repeat, max_size):
+        self.corpora = corpora
+        self.font_path = font_path
+        self.repeat = repeat
+        self.max_size = max_size
+        self.frequencies = None
+        self.layouts = {}
+
+
+# =========================================================
+# 結果の保存と比較
+# =========================================================
+def collect_meta(args):
+    meta = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "repeat": args.repeat,
+        "font": os.path.basename(args.font),
+    }
+    try:
+        meta["git_commit"] = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except Exception:
+        meta["git_commit"] = None
+    versions = {}
+    for module in ("janome", "fugashi", "ipadic", "wordcloud", "numpy", "PIL"):
+        try:
+            versions[module] = getattr(__import__(module), "__version__", None)
+        except ImportError:
+            versions[module] = None
+    meta["versions"] = versions
+    meta["tokenizer_backend"] = morphology.resolve_backend_name()
+    return meta
+
+
+def result_key(result):
+    return result["stage"], json.dumps(result["params"], sort_keys=True, ensure_ascii=False)
+
+
+def compare(old_results, new_results, out=sys.stderr):
+    """
+    同じ (stage, params) の中央値を比べる。ratio > 1 は遅くなったことを表す。
+    """
+    old = {result_key(r): r for r in old_results}
+    print(f"{'stage':<26} {'params':<60} {'old_s':>10} {'new_s':>10} {'ratio':>7}", file=out)
+    for result in new_results:
+        before = old.get(result_key(result))
+        if before is None:
+            continue
+        ratio = result["median_s"] / before["median_s"] if before["median_s"] else float("inf")
+        print(
+            f"{result['stage']:<26} {result_key(result)[1]:<60} "
+            f"{before['median_s']:>10.4f} {result['median_s']:>10.4f} {ratio:>7.2f}",
+            file=out,
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ワードクラウド生成のベンチマーク")
+    parser.add_argument("--only", action="append", choices=list(BENCHMARKS), help="実行する段階（複数指定可）")
+    parser.add_argument("--repeat", type=int, default=3, help="各計測の繰り返し回数")
+    parser.add_argument("--max-size", default="50MB", help="合成コーパスの最大サイズ（例: 1MB）")
+    parser.add_argument("--quick", action="store_true", help=f"合成コーパスを{format_size(QUICK_MAX_SIZE)}までにし、1回ずつ測る")
+    parser.add_argument("--fixture", action="append", default=[], help="追加で測るコーパスのファイル（.txt）")
+    parser.add_argument("--font", default=DEFAULT_FONT_PATH, help="フォントファイルのパス")
+    parser.add_argument("--output", help="結果のJSONの保存先（省略時は標準出力）")
+    parser.add_argument("--compare", help="比べる前回の結果のJSON")
+    args = parser.parse_args(argv)
+
+    max_size = parse_size(args.max_size)
+    if args.quick:
+        max_size = min(max_size, QUICK_MAX_SIZE)
+        args.repeat = 1
+    sizes = [size for size in CORPUS_SIZES if size <= max_size]
+
+    ctx = BenchContext(Corpora(sizes, args.fixture), args.font, args.repeat, max_size)
+    results = []
+    for name in args.only or list(BENCHMARKS):
+        for result in BENCHMARKS[name](ctx):
+            log(f"{result['stage']:<26} {json.dumps(result['params'], ensure_ascii=False):<60} {result['median_s']:.4f}s")
+            results.append(result)
+
+    report = {"meta": collect_meta(args), "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        sys.stdout.write("\n")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f)["results"], results)
+
+    mismatched = [r for r in results if r.get("parity_ok") is False]
+    for result in mismatched:
+        log(f"集計結果が一致しません: {result['stage']} {json.dumps(result['params'], ensure_ascii=False)} {result['parity_diff'][:5]}")
+    return 1 if mismatched else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
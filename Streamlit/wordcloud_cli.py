@@ -0,0 +1,165 @@
+"""
+ワードクラウドの一括生成（Streamlitを使わないコマンドライン版）。
+
+使い方:
+    python Streamlit/wordcloud_cli.py 入力 --settings settings.json --out-dir out/
+
+入力:
+    - ディレクトリ: 中の .txt / .csv をすべて処理する（サブディレクトリも含む）
+    - マニフェスト（.jsonl）: 1行に1件 {"input": "a.txt", "output": "a.png", "settings": {...}}
+      （output と settings は省略可。settings は --settings の内容を上書きする）
+    - マニフェスト（それ以外）: 1行に1つ入力ファイルのパス
+
+設定ファイルは画面の「入力内容を保存」と同じ形式（last_settings）のJSON。
+保存履歴の1件（{"settings": {...}} の形）をそのまま渡してもよい。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import secrets
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from wordcloud_core import init_generation_worker, render_from_settings
+from wordcloud_settings import DEFAULT_FONT_PATH, IMAGE_FORMATS, INPUT_EXTENSIONS, load_settings, normalize_settings
+
+
+# =========================================================
+# 入力の列挙
+# =========================================================
+def iter_jobs(input_path, out_dir, ext):
+    """
+    (入力ファイル, 出力ファイル, 上書きする設定) を列挙する。
+    """
+    if os.path.isdir(input_path):
+        for root, dirs, files in os.walk(input_path):
+            dirs.sort()
+            for name in sorted(files):
+                if not name.lower().endswith(INPUT_EXTENSIONS):
+                    continue
+                src = os.path.join(root, name)
+                rel = os.path.splitext(os.path.relpath(src, input_path))[0]
+                yield src, os.path.join(out_dir, f"{rel}.{ext}"), {}
+        return
+
+    base_dir = os.path.dirname(os.path.abspath(input_path))
+    with open(input_path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if input_path.lower().endswith(".jsonl"):
+                item = json.loads(line)
+                src = item["input"]
+                dst = item.get("output")
+                overrides = item.get("settings") or {}
+            else:
+                src, dst, overrides = line, None, {}
+            src = os.path.join(base_dir, src)
+            if dst is None:
+                dst = f"{os.path.splitext(os.path.basename(src))[0]}.{ext}"
+            yield src, os.path.join(out_dir, dst), overrides
+
+
+# =========================================================
+# ワーカー（1プロセスに1つのトークナイザとフォント）
+# =========================================================
+def generate_file(src, dst, settings, font_path, output_options, mask_bytes=None):
+    """
+    1ファイル分を生成して書き出す。戻り値は (入力, 出力, 秒数, エラーメッセージ or None)。
+    """
+    started = time.perf_counter()
+    try:
+        with open(src, "rb") as f:
+            data = render_from_settings(
+                settings, font_path, binary_file=f, output_options=output_options, mask_bytes=mask_bytes
+            )
+        os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+        tmp = f"{dst}.tmp{os.getpid()}"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, dst)
+        return src, dst, time.perf_counter() - started, None
+    except Exception as e:
+        return src, dst, time.perf_counter() - started, f"{type(e).__name__}: {e}"
+
+
+# =========================================================
+# main
+# =========================================================
+def build_parser():
+    parser = argparse.ArgumentParser(description="ワードクラウドを一括で生成します。")
+    parser.add_argument("input", help="入力ディレクトリ、またはマニフェストファイル（.jsonl / 1行1パス）")
+    parser.add_argument("--settings", help="設定のJSON（画面の保存データ last_settings と同じ形式）")
+    parser.add_argument("--out-dir", default="wordcloud_out", help="出力先ディレクトリ（既定: wordcloud_out）")
+    parser.add_argument("--font", default=DEFAULT_FONT_PATH, help="フォントファイルのパス")
+    parser.add_argument("--format", default="PNG", choices=list(IMAGE_FORMATS), help="画像の形式")
+    parser.add_argument("--png-compress-level", type=int, default=6, help="PNGの圧縮レベル（0〜9）")
+    parser.add_argument("--quality", type=int, default=90, help="WebP / JPEGの画質（1〜100）")
+    parser.add_argument("--seed", type=int, help="乱数シード（設定に seed が無いファイルに使う）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="ワーカープロセス数")
+    parser.add_argument("--skip-existing", action="store_true", help="出力ファイルが既にあれば生成しない")
+    parser.add_argument("--mask", help="マスク画像（暗い部分にだけ単語を置く）。輪郭線は設定の contour_width / contour_color")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if not os.path.exists(args.font):
+        print(f"フォントが見つかりません: {args.font}", file=sys.stderr)
+        return 2
+
+    mask_bytes = None
+    if args.mask:
+        with open(args.mask, "rb") as f:
+            mask_bytes = f.read()
+
+    base_settings = load_settings(args.settings)
+    output_options = {
+        "image_format": args.format,
+        "png_compress_level": args.png_compress_level,
+        "quality": args.quality,
+    }
+    ext = IMAGE_FORMATS[args.format][1]
+
+    jobs = []
+    for src, dst, overrides in iter_jobs(args.input, args.out_dir, ext):
+        if args.skip_existing and os.path.exists(dst):
+            continue
+        settings = normalize_settings({**base_settings, **overrides})
+        if settings["seed"] is None:
+            settings["seed"] = args.seed if args.seed is not None else secrets.randbelow(2**31 - 1)
+        jobs.append((src, dst, settings))
+
+    if not jobs:
+        print("処理するファイルがありません。", file=sys.stderr)
+        return 0
+
+    failed = 0
+    started = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=max(1, min(args.workers, len(jobs))),
+        initializer=init_generation_worker,
+        initargs=(args.font,),
+    ) as executor:
+        futures = [
+            executor.submit(generate_file, src, dst, settings, args.font, output_options, mask_bytes)
+            for src, dst, settings in jobs
+        ]
+        for done, future in enumerate(as_completed(futures), 1):
+            src, dst, seconds, error = future.result()
+            if error:
+                failed += 1
+                print(f"[{done}/{len(jobs)}] 失敗 {src}: {error}", file=sys.stderr)
+            else:
+                print(f"[{done}/{len(jobs)}] {src} -> {dst} ({seconds:.1f}s)", file=sys.stderr)
+
+    elapsed = time.perf_counter() - started
+    print(f"{len(jobs) - failed}件成功 / {failed}件失敗（{elapsed:.1f}秒）", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,812 @@
+"""
+ワードクラウド生成の本体（Streamlitに依存しない）。
+
+Streamlitアプリ（wordcloud_app.py）、一括生成のCLI（wordcloud_cli.py）から共通で使う。
+キャッシュはプロセス内で共有される。
+"""
+import os
+import io
+import sys
+import copy
+import json
+import bisect
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache, wraps
+from random import Random
+import matplotlib
+import numpy as np
+from PIL import Image, ImageColor, ImageFont, ImageOps
+import wordcloud.wordcloud as wordcloud_module
+from wordcloud import WordCloud
+import morphology
+from instrumentation import span, start_memory_tracing
+from wordcloud_settings import IMAGE_FORMATS, normalize_settings, split_comma_list
+from morphology import (
+    PARALLEL_MIN_CHARS,
+    parallel_enabled,
+    tokenize_japanese,
+    tokenize_japanese_parallel,
+    tokenize_japanese_dedup,
+    open_text_stream,
+    iter_text_chunks,
+    iter_csv_chunks,
+    count_words_from_chunks,
+    count_words_parallel,
+    get_default_japanese_stopwords,
+)
+
+
+def process_singleton(factory):
+    """
+    引数なしの関数をプロセス内で1回だけ実行し、その結果を返し続けるようにする。
+    （Streamlitの st.cache_resource と同じ役割。スレッドセーフ）
+    """
+    lock = threading.Lock()
+    holder = []
+
+    @wraps(factory)
+    def get():
+        if not holder:
+            with lock:
+                if not holder:
+                    holder.append(factory())
+        return holder[0]
+
+    return get
+
+
+
+# =========================================================
+# 解析結果のキャッシュ（全セッションで共有）
+# =========================================================
+# 見た目の設定（幅・高さ・色など）だけを変えたときは形態素解析をやり直さない
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("WORDCLOUD_TOKEN_CACHE_MAX_ENTRIES", "128"))
+TOKEN_CACHE_MAX_BYTES = int(os.getenv("WORDCLOUD_TOKEN_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+class LRUCache:
+    """
+    件数とおおよそのバイト数の両方で上限を持つLRUキャッシュ。
+    上限を超えたら最も長く使われていないものから捨てる。
+    """
+
+    def __init__(self, max_entries, max_bytes, sizeof=sys.getsizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._data = OrderedDict()  # key -> (value, nbytes)
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        nbytes = self._sizeof(value)
+        if nbytes > self.max_bytes:
+            # 1件で上限を超えるものはキャッシュしない
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[1]
+            self._data[key] = (value, nbytes)
+            self._nbytes += nbytes
+            while len(self._data) > self.max_entries or self._nbytes > self.max_bytes:
+                _, (_, evicted) = self._data.popitem(last=False)
+                self._nbytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._nbytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+
+def _sizeof_counts(counts):
+    # dict本体 + キー文字列 + int値 のおおよそのバイト数
+    if isinstance(counts, tuple):
+        # (counts, 統計) の形で入れているもの
+        return _sizeof_counts(counts[0]) + sys.getsizeof(counts[1])
+    return sys.getsizeof(counts) + sum(sys.getsizeof(w) + 28 for w in counts)
+
+
+@process_singleton
+def get_token_cache():
+    return LRUCache(TOKEN_CACHE_MAX_ENTRIES, TOKEN_CACHE_MAX_BYTES, sizeof=_sizeof_counts)
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def hash_stream(binary, block_size=1024 * 1024):
+    # アップロードファイルなどを全体を一度に読まずにハッシュする
+    h = hashlib.sha256()
+    binary.seek(0)
+    for block in iter(lambda: binary.read(block_size), b""):
+        h.update(block)
+    binary.seek(0)
+    return h.hexdigest()
+
+
+def make_token_cache_key(content_digest, selected_pos, exclude_words, priority_nouns, normalize=False):
+    # 品詞・除外語・優先名詞は順序に意味がないので正規化してからハッシュする
+    h = hashlib.sha256()
+    h.update(content_digest.encode("ascii"))
+    h.update(b"\0")
+    h.update(json.dumps(
+        [
+            sorted(set(selected_pos or [])),
+            sorted(set(exclude_words or [])),
+            sorted(set(w for w in (priority_nouns or []) if w)),
+            bool(normalize),
+        ],
+        ensure_ascii=False,
+    ).encode("utf-8"))
+    return h.hexdigest()
+
+
+
+# 生成した画像のキャッシュ（入力内容のハッシュ＋全設定＋シードがキー）。
+# 画像そのものは image_store に置き、ここには参照だけを入れる
+IMAGE_CACHE_MAX_ENTRIES = int(os.getenv("WORDCLOUD_IMAGE_CACHE_MAX_ENTRIES", "1024"))
+
+
+@process_singleton
+def get_image_cache():
+    # 参照は1件100バイト程度なので件数だけで制限する
+    return LRUCache(IMAGE_CACHE_MAX_ENTRIES, IMAGE_CACHE_MAX_ENTRIES * 1024)
+
+
+# 配置済みのWordCloud（layout_）のキャッシュ。キーに色の設定は含めないので、
+# 色・出力形式だけ変えたときや原寸での書き出しでは配置を計算し直さない
+LAYOUT_CACHE_MAX_ENTRIES = int(os.getenv("WORDCLOUD_LAYOUT_CACHE_MAX_ENTRIES", "64"))
+LAYOUT_CACHE_MAX_BYTES = int(os.getenv("WORDCLOUD_LAYOUT_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+
+def _sizeof_layout(wordcloud):
+    # layout_ の1語あたり ((単語, 頻度), サイズ, 位置, 向き, 色) でおおよそ300バイト
+    # マスクの配列はマスクのキャッシュと共有しているが、そちらから消えても残るので数えておく
+    mask_bytes = wordcloud.mask.nbytes if getattr(wordcloud, "mask", None) is not None else 0
+    return 1024 + 300 * len(getattr(wordcloud, "layout_", ())) + mask_bytes
+
+
+@process_singleton
+def get_layout_cache():
+    return LRUCache(LAYOUT_CACHE_MAX_ENTRIES, LAYOUT_CACHE_MAX_BYTES, sizeof=_sizeof_layout)
+
+
+def make_image_cache_key(content_digest, settings, font_path, output_options=None):
+    payload = json.dumps(
+        {
+            "content": content_digest,
+            "settings": settings,
+            "font_path": font_path,
+            "output": output_options or {},
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def tokenize_japanese_cached(text, selected_pos, exclude_words=None, priority_nouns=None, normalize=False):
+    cache = get_token_cache()
+    with span("tokenize", chars=len(text)) as s:
+        key = make_token_cache_key(hash_text(text), selected_pos, exclude_words, priority_nouns, normalize)
+        counts = cache.get(key)
+        s.counts["cache_hit"] = int(counts is not None)
+        if counts is None:
+            if parallel_enabled() and len(text) >= PARALLEL_MIN_CHARS:
+                counts = tokenize_japanese_parallel(text, selected_pos, exclude_words, priority_nouns, normalize)
+            else:
+                counts = tokenize_japanese(text, selected_pos, exclude_words, priority_nouns, normalize)
+            cache.put(key, counts)
+        _count_span_words(s, counts)
+    return counts
+
+
+def tokenize_japanese_dedup_cached(text, selected_pos, exclude_words=None, priority_nouns=None, normalize=False):
+    """
+    重複する文をまとめて解析する。戻り値は (単語→出現回数, 統計)。
+    """
+    cache = get_token_cache()
+    with span("tokenize", attrs={"dedup": True}, chars=len(text)) as s:
+        key = "dedup:" + make_token_cache_key(
+            hash_text(text), selected_pos, exclude_words, priority_nouns, normalize
+        )
+        result = cache.get(key)
+        s.counts["cache_hit"] = int(result is not None)
+        if result is None:
+            result = tokenize_japanese_dedup(text, selected_pos, exclude_words, priority_nouns, normalize=normalize)
+            cache.put(key, result)
+        _count_span_words(s, result[0])
+        s.counts["tokenized_chars"] = result[1]["tokenized_chars"]
+    return result
+
+
+def _count_span_words(s, counts):
+    s.counts["words"] = sum(counts.values())
+    s.counts["unique_words"] = len(counts)
+
+
+def _stream_size(binary):
+    binary.seek(0, os.SEEK_END)
+    size = binary.tell()
+    binary.seek(0)
+    return size
+
+
+def tokenize_file_cached(
+    binary_file, selected_pos, exclude_words=None, priority_nouns=None, content_digest=None, normalize=False
+):
+    """
+    .txt / .csv のファイル（バイナリで開いたもの、Streamlitのアップロードファイルも可）を
+    チャンクごとに解析して 単語→出現回数 を返す。
+    結果はファイル内容のハッシュをキーにしてテキスト入力と同じキャッシュに入れる。
+    """
+    cache = get_token_cache()
+    with span("tokenize", bytes=_stream_size(binary_file)) as s:
+        content_digest = content_digest or hash_stream(binary_file)
+        key = make_token_cache_key(content_digest, selected_pos, exclude_words, priority_nouns, normalize)
+        counts = cache.get(key)
+        s.counts["cache_hit"] = int(counts is not None)
+        if counts is None:
+            is_csv = getattr(binary_file, "name", "").lower().endswith(".csv")
+            # 大きなファイルはチャンクをワーカープロセスに振り分ける
+            use_parallel = parallel_enabled() and s.counts["bytes"] >= PARALLEL_MIN_CHARS
+            count_chunks = count_words_parallel if use_parallel else count_words_from_chunks
+            with open_text_stream(binary_file) as stream:
+                chunks = iter_csv_chunks(stream) if is_csv else iter_text_chunks(stream)
+                counts = count_chunks(chunks, selected_pos, exclude_words, priority_nouns, normalize)
+            cache.put(key, counts)
+        _count_span_words(s, counts)
+    return counts
+
+
+
+# =========================================================
+# 視認性を考慮したカラーパレット（カラーマップ×背景色ごとに事前計算）
+# =========================================================
+CONTRAST_PALETTE_SIZE = 256
+# 背景が明るい場合は輝度180以上、暗い場合は輝度80以下の文字色を避ける
+BRIGHT_BACKGROUND_LUMINANCE = 128
+MAX_WORD_LUMINANCE_ON_BRIGHT = 180
+MIN_WORD_LUMINANCE_ON_DARK = 80
+LUMINANCE_WEIGHTS = np.array([0.299, 0.587, 0.114])
+
+
+@lru_cache(maxsize=64)
+def get_contrast_palette(colormap, background_color):
+    """
+    カラーマップを等間隔にサンプリングし、背景色に対して視認性の低い色を除いた
+    "rgb(r, g, b)" 文字列のタプルを返す。
+    条件を満たす色が1つもない場合は、カラーマップの色を暗く（明るく）して条件を満たすようにする。
+    """
+    try:
+        cmap = matplotlib.colormaps[colormap]
+    except (KeyError, ValueError):
+        cmap = matplotlib.colormaps["viridis"]  # エラー時のフォールバック
+
+    # RGB (0-1) を 0-255 に変換
+    rgb = (cmap(np.linspace(0, 1, CONTRAST_PALETTE_SIZE))[:, :3] * 255).astype(np.int64)
+    luminance = rgb @ LUMINANCE_WEIGHTS
+
+    # 背景色の明るさ (0:黒 ～ 255:白)
+    bg_luminance = float(np.array(ImageColor.getrgb(background_color)[:3]) @ LUMINANCE_WEIGHTS)
+    is_bright_background = bg_luminance > BRIGHT_BACKGROUND_LUMINANCE
+
+    if is_bright_background:
+        ok = luminance < MAX_WORD_LUMINANCE_ON_BRIGHT
+    else:
+        ok = luminance > MIN_WORD_LUMINANCE_ON_DARK
+
+    if ok.any():
+        palette = rgb[ok]
+    elif is_bright_background:
+        # 明るすぎる色を黒に向かって暗くする
+        factor = (MAX_WORD_LUMINANCE_ON_BRIGHT - 1) / np.maximum(luminance, 1)
+        palette = np.floor(rgb * np.minimum(factor, 1)[:, None]).astype(np.int64)
+    else:
+        # 暗すぎる色を白に向かって明るくする
+        t = (MIN_WORD_LUMINANCE_ON_DARK + 1 - luminance) / np.maximum(255 - luminance, 1)
+        palette = np.ceil(rgb + (255 - rgb) * np.clip(t, 0, 1)[:, None]).astype(np.int64)
+
+    return tuple(f"rgb({r}, {g}, {b})" for r, g, b in palette.tolist())
+
+
+def make_contrast_color_func(colormap, background_color):
+    palette = get_contrast_palette(colormap, background_color)
+    last = len(palette) - 1
+
+    # --- コントラスト調整用のカラー関数 ---
+    def color_func_with_contrast(word, font_size, position, orientation, random_state=None, **kwargs):
+        if random_state is None:
+            random_state = Random()
+        return palette[random_state.randint(0, last)]
+
+    return color_func_with_contrast
+
+
+
+# =========================================================
+# フォントのキャッシュ（全セッションで共有）
+# =========================================================
+# WordCloudは配置・描画のたびに ImageFont.truetype(font_path, 大きさ) を何百回も呼び、
+# そのたびにフォントファイルを読み直す（日本語のOTFは大きいので遅い）。
+# 読み込んだフォントを (パス, 大きさ) ごとに使い回す。
+FONT_CACHE_MAX_ENTRIES = int(os.getenv("WORDCLOUD_FONT_CACHE_MAX_ENTRIES", "1024"))
+FONT_CACHE_MAX_BYTES = int(os.getenv("WORDCLOUD_FONT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# 読み込んだフォント1つあたりのメモリの見積もり（FreeTypeの中なので正確には測れない。
+# DejaVu Sansで約0.25MB、日本語のOTFはそれより大きいので余裕を見ている）
+FONT_FACE_ESTIMATED_BYTES = int(os.getenv("WORDCLOUD_FONT_FACE_ESTIMATED_BYTES", str(512 * 1024)))
+
+
+class FontCache:
+    """
+    (パス, 大きさ) → 読み込んだフォント。上限に達したら大きい文字サイズから捨てる。
+
+    WordCloudは最初に「上位2語がキャンバスに収まる大きさ」をキャンバスの高さから1ずつ
+    小さくして探すので、1回の配置で高さと同じくらいの種類の大きさを1回ずつ使う。
+    LRUだと上限より多い種類を順に使うたびに全部入れ替わって当たらなくなるので、
+    どのキャンバスでも・最後の描画でも使う小さい文字サイズを優先して残す。
+    """
+
+    def __init__(self, max_entries, max_bytes, face_bytes):
+        self.max_entries = max(1, min(max_entries, max_bytes // max(1, face_bytes)))
+        self.face_bytes = face_bytes
+        self._data = {}
+        self._by_size = []  # (大きさ, パス) の昇順
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            font = self._data.get(key)
+            if font is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return font
+
+    def put(self, key, font):
+        path, size = key
+        with self._lock:
+            if key in self._data:
+                return
+            if len(self._data) >= self.max_entries:
+                largest = self._by_size[-1]
+                if size >= largest[0]:
+                    # 入っているものより大きい文字サイズは入れない
+                    return
+                self._by_size.pop()
+                del self._data[(largest[1], largest[0])]
+            self._data[key] = font
+            bisect.insort(self._by_size, (size, path))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._by_size.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def nbytes(self):
+        return len(self._data) * self.face_bytes
+
+
+@process_singleton
+def get_font_cache():
+    return FontCache(FONT_CACHE_MAX_ENTRIES, FONT_CACHE_MAX_BYTES, FONT_FACE_ESTIMATED_BYTES)
+
+
+def get_font(font_path, size):
+    """
+    (パス, 大きさ) ごとに読み込んだフォントを返す。
+    複数のセッションで同じオブジェクトを使うので、呼び出し側で変更しないこと
+    （PillowのFreeType処理はGILを持ったまま動くので、同時に使っても壊れない）。
+    """
+    cache = get_font_cache()
+    key = (font_path, size)
+    font = cache.get(key)
+    if font is None:
+        font = ImageFont.truetype(font_path, size)
+        cache.put(key, font)
+    return font
+
+
+class _CachedImageFont:
+    """
+    wordcloud.wordcloud から見える ImageFont の代わり。truetype() だけキャッシュを通す。
+    """
+
+    def __getattr__(self, name):
+        return getattr(ImageFont, name)
+
+    @staticmethod
+    def truetype(font=None, size=10, *args, **kwargs):
+        if args or kwargs or not isinstance(font, str):
+            return ImageFont.truetype(font, size, *args, **kwargs)
+        return get_font(font, size)
+
+
+# WordCloudの中の ImageFont.truetype 呼び出しをキャッシュ経由にする
+wordcloud_module.ImageFont = _CachedImageFont()
+
+
+# =========================================================
+# マスク画像（形に沿って配置する。全セッションで共有のキャッシュ）
+# =========================================================
+# 同じマスク画像・同じ大きさなら、読み込み・縮小・2値化をやり直さない
+MASK_CACHE_MAX_ENTRIES = int(os.getenv("WORDCLOUD_MASK_CACHE_MAX_ENTRIES", "32"))
+MASK_CACHE_MAX_BYTES = int(os.getenv("WORDCLOUD_MASK_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# これより暗い画素に単語を置く（明るい部分・透明な部分には置かない）
+MASK_THRESHOLD = 128
+
+
+@process_singleton
+def get_mask_cache():
+    return LRUCache(MASK_CACHE_MAX_ENTRIES, MASK_CACHE_MAX_BYTES, sizeof=lambda mask: mask.nbytes)
+
+
+def _load_mask_image(mask_bytes, width, height):
+    img = Image.open(io.BytesIO(mask_bytes))
+    # JPEGは縮小しながら展開できる（大きな写真でも原寸のまま展開しない）
+    img.draft("L", (width, height))
+    if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        # 透明な部分は白（置かない）にする
+        rgba = img.convert("RGBA")
+        img = Image.new("RGBA", rgba.size, "white")
+        img.alpha_composite(rgba)
+    img = img.convert("L")
+    if img.width > width or img.height > height:
+        # 大きな画像は段階的に縮小する（原寸でのリサンプリングを避ける）
+        img.thumbnail((width, height), Image.Resampling.BILINEAR, reducing_gap=2.0)
+    return ImageOps.contain(img, (width, height))
+
+
+def _preprocess_mask(mask_bytes, width, height):
+    img = _load_mask_image(mask_bytes, width, height)
+    # 縦横比を保ったまま中央に置き、余白は置かない部分にする
+    canvas = Image.new("L", (width, height), 255)
+    canvas.paste(img, ((width - img.width) // 2, (height - img.height) // 2))
+    gray = np.asarray(canvas)
+    # WordCloudは値が255の画素にだけ単語を置かない
+    mask = np.where(gray < MASK_THRESHOLD, 0, 255).astype(np.uint8)
+    if not (mask == 0).any():
+        raise ValueError("マスク画像に単語を置ける部分（暗い部分）がありません。")
+    # キャッシュ上の配列を複数のセッションで共有するので書き換えられないようにする
+    mask.flags.writeable = False
+    return mask
+
+
+def prepare_mask(mask_bytes, width, height, mask_digest=None):
+    """
+    マスク画像（PNG / JPEG などのバイト列）を width×height のWordCloud用の配列にする
+    （0: 単語を置ける、255: 置かない）。(画像のハッシュ, 大きさ) ごとにキャッシュする。
+    """
+    cache = get_mask_cache()
+    with span("mask", attrs={"width": width, "height": height}) as s:
+        mask_digest = mask_digest or hashlib.sha256(mask_bytes).hexdigest()
+        key = (mask_digest, width, height)
+        mask = cache.get(key)
+        s.counts["cache_hit"] = int(mask is not None)
+        if mask is None:
+            mask = _preprocess_mask(mask_bytes, width, height)
+            cache.put(key, mask)
+    return mask
+
+
+
+# =========================================================
+# ワードクラウド生成
+# =========================================================
+def warm_up_font(font_path):
+    """
+    フォントを一度読み込んでおく（ファイルをOSのキャッシュに載せ、読み込みの初期化を済ませる）。
+    """
+    get_font(font_path, 32)
+
+
+class CancellableWordCloud(WordCloud):
+    """
+    配置の途中で止められる WordCloud。
+    generate_from_frequencies() は単語ごとに文字の大きさを1段ずつ小さくしながら置ける場所を探し、
+    そのたびに min_font_size を読むので、そこで check_cancelled() を呼ぶ
+    （大きなキャンバスでは1語の場所探しに10秒以上かかることがあり、単語の間で確かめるだけでは足りない）。
+    """
+
+    check_cancelled = None
+
+    @property
+    def min_font_size(self):
+        if self.check_cancelled is not None:
+            self.check_cancelled()
+        return self._min_font_size
+
+    @min_font_size.setter
+    def min_font_size(self, value):
+        self._min_font_size = value
+
+
+def _layout_color_func(word, font_size, position, orientation, random_state=None, **kwargs):
+    # 配置の計算中は乱数を使わない（色は後から color_wordcloud で付ける）
+    # こうしておくと、色の設定を変えても同じシードなら配置が変わらない
+    return "black"
+
+def layout_wordcloud(
+    text,
+    width,
+    height,
+    font_path,
+    selected_pos,
+    exclude_words=None,
+    priority_nouns=None,
+    max_words=50,
+    collocations=False,
+    min_font_size=10,
+    is_horizontal_only=True,
+    frequencies=None,
+    random_state=None,
+    layout_scale=1,
+    normalize=False,
+    mask_bytes=None,
+    mask_digest=None,
+    check_cancelled=None,
+):
+    """
+    単語の配置だけを計算する（色は付けない）。
+    frequencies（単語→出現回数）が渡された場合はtextの解析を省略する。
+    layout_scale > 1 のときは 1/layout_scale に縮小したキャンバスで配置を計算する
+    （原寸の画像は render_wordcloud_to_bytes(scale=layout_scale) で同じ配置のまま描画できる）。
+    mask_bytes（マスク画像）を渡すと、その暗い部分にだけ単語を置く。
+    check_cancelled は配置の途中で何度も呼ぶ（例外を送出すれば配置の途中で止まる）。
+    """
+    horizontal = 1.0 if is_horizontal_only else 0.5
+    if frequencies is None:
+        frequencies = tokenize_japanese_cached(text, selected_pos, exclude_words, priority_nouns, normalize)
+    if layout_scale > 1:
+        width = max(1, width // layout_scale)
+        height = max(1, height // layout_scale)
+        min_font_size = max(1, round(min_font_size / layout_scale))
+    mask = prepare_mask(mask_bytes, width, height, mask_digest) if mask_bytes else None
+
+    attrs = {"width": width, "height": height, "layout_scale": layout_scale}
+    with span("layout", attrs=attrs, unique_words=len(frequencies)) as s:
+        wordcloud = CancellableWordCloud(
+            font_path=font_path,
+            width=width,
+            height=height,
+            max_words=max_words,
+            min_font_size=min_font_size,
+            collocations=collocations,
+            color_func=_layout_color_func,
+            prefer_horizontal=horizontal,
+            random_state=random_state,
+            mask=mask,
+        )
+        wordcloud.check_cancelled = check_cancelled
+        try:
+            wordcloud.generate_from_frequencies(frequencies)
+        finally:
+            # キャッシュする配置がジョブを参照し続けないようにする
+            wordcloud.check_cancelled = None
+        s.counts["placed_words"] = len(wordcloud.layout_)
+    return wordcloud
+
+def color_wordcloud(
+    wordcloud,
+    background_color,
+    colormap=None,
+    check_contrast=True,
+    random_state=None,
+    contour_width=0,
+    contour_color="#000000",
+):
+    """
+    配置済みのWordCloudに色を付けたコピーを返す（配置はそのまま、元のオブジェクトは変更しない）。
+    contour_width > 0 のときはマスクの輪郭線を描く（マスクを使っていない場合は何もしない）。
+    """
+    with span("color", placed_words=len(wordcloud.layout_)):
+        wordcloud = copy.copy(wordcloud)
+        wordcloud.background_color = background_color
+        wordcloud.contour_width = contour_width
+        wordcloud.contour_color = contour_color
+        if check_contrast:
+            color_func = make_contrast_color_func(colormap, background_color)
+            wordcloud.recolor(random_state=random_state, color_func=color_func)
+        else:
+            wordcloud.recolor(random_state=random_state, colormap=colormap or "viridis")
+    return wordcloud
+
+def generate_wordcloud(
+    text,
+    width,
+    height,
+    background_color,
+    font_path,
+    selected_pos,
+    exclude_words=None,
+    priority_nouns=None,
+    max_words=50,
+    collocations=False,
+    min_font_size=10,
+    colormap=None,
+    is_horizontal_only=True,
+    check_contrast=True,
+    frequencies=None,
+    random_state=None,
+    layout_scale=1,
+    normalize=False,
+    mask_bytes=None,
+    contour_width=0,
+    contour_color="#000000",
+):
+    # --- ワードクラウドの生成（配置 → 色付け） ---
+    wordcloud = layout_wordcloud(
+        text,
+        width,
+        height,
+        font_path,
+        selected_pos,
+        exclude_words,
+        priority_nouns,
+        max_words=max_words,
+        collocations=collocations,
+        min_font_size=min_font_size,
+        is_horizontal_only=is_horizontal_only,
+        frequencies=frequencies,
+        random_state=random_state,
+        layout_scale=layout_scale,
+        normalize=normalize,
+        mask_bytes=mask_bytes,
+    )
+    return color_wordcloud(
+        wordcloud, background_color, colormap, check_contrast, random_state, contour_width, contour_color
+    )
+
+
+def wordcloud_to_image(wordcloud, scale=1, size=None):
+    """
+    配置済みのWordCloudを scale 倍で描画する。
+    sizeを指定した場合、縮小時に割り切れなかった分の端を背景色で埋めて、その大きさにそろえる。
+    """
+    # キャッシュ上のWordCloudを複数のセッションで共有しているので、scaleはコピーにだけ設定する
+    wordcloud = copy.copy(wordcloud)
+    wordcloud.scale = scale
+    img = wordcloud.to_image()
+    if size is not None and img.size != tuple(size):
+        canvas = Image.new(img.mode, tuple(size), wordcloud.background_color)
+        canvas.paste(img, ((size[0] - img.width) // 2, (size[1] - img.height) // 2))
+        img = canvas
+    return img
+
+
+def render_wordcloud_to_bytes(wordcloud, image_format="PNG", compress_level=6, quality=90, scale=1, size=None):
+    """
+    WordCloudの画像をPILで直接エンコードする（matplotlibの図は作らない）。
+    compress_levelはPNG（0〜9）、qualityはWebP/JPEG（1〜100）に使う。
+    scale / size はプレビュー用に縮小して配置したものを原寸で書き出すときに指定する。
+    """
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"未対応の画像形式です: {image_format}")
+    pil_format = IMAGE_FORMATS[image_format][0]
+
+    with span("encode", attrs={"format": image_format}) as s:
+        img = wordcloud_to_image(wordcloud, scale=scale, size=size)
+        buf = io.BytesIO()
+        if pil_format == "PNG":
+            img.save(buf, format="PNG", compress_level=int(compress_level))
+        elif pil_format == "JPEG":
+            img.convert("RGB").save(buf, format="JPEG", quality=int(quality))
+        else:
+            img.save(buf, format=pil_format, quality=int(quality))
+        s.attrs.update(width=img.width, height=img.height)
+        s.counts["bytes"] = buf.tell()
+    return buf.getvalue()
+
+def render_wordcloud_to_png_bytes(wordcloud, compress_level=6):
+    return render_wordcloud_to_bytes(wordcloud, "PNG", compress_level=compress_level)
+
+
+
+# =========================================================
+# 設定（Streamlitの last_settings と同じ形式）からの生成
+# =========================================================
+def generate_from_settings(
+    settings, font_path, text=None, binary_file=None, layout_scale=1, frequencies=None, mask_bytes=None
+):
+    """
+    last_settings と同じ形式の設定から色付きのWordCloudを作る。
+    入力は text（文字列）か binary_file（.txt / .csv をバイナリで開いたもの）、
+    または解析済みの frequencies（単語→出現回数）のどれか。
+    mask_bytes はマスク画像（省略可）。
+    """
+    settings = normalize_settings(settings)
+    selected_pos = settings["selected_pos"]
+    exclude_words = split_comma_list(settings["exclude_input"])
+    if settings["use_default_stopwords"]:
+        exclude_words += get_default_japanese_stopwords()
+    priority_nouns = split_comma_list(settings["priority_nouns_input"])
+    normalize = settings["normalize_text"]
+
+    if frequencies is None and binary_file is not None:
+        frequencies = tokenize_file_cached(
+            binary_file, selected_pos, exclude_words, priority_nouns, normalize=normalize
+        )
+
+    return generate_wordcloud(
+        text or "",
+        settings["width"],
+        settings["height"],
+        settings["background_color"],
+        font_path,
+        selected_pos,
+        exclude_words,
+        priority_nouns=priority_nouns,
+        max_words=settings["max_words"],
+        min_font_size=settings["min_font_size"],
+        colormap=settings["colormap"],
+        is_horizontal_only=settings["is_horizontal_only"],
+        check_contrast=settings["check_contrast"],
+        frequencies=frequencies,
+        random_state=settings["seed"],
+        layout_scale=layout_scale,
+        normalize=normalize,
+        mask_bytes=mask_bytes,
+        contour_width=settings["contour_width"],
+        contour_color=settings["contour_color"],
+    )
+
+
+def init_generation_worker(font_path):
+    """
+    一括生成・HTTPサービスのワーカープロセスの初期化。
+    トークナイザを1つ用意して温め、フォントを一度読み込んでおく。
+    """
+    # 呼び出し側がリクエスト・ファイル単位で並列化するので、1件の中での並列解析は使わない
+    morphology.PARALLEL_WORKERS = 1
+    morphology.TOKENIZER_POOL_SIZE = 1
+    morphology.get_tokenizer_pool()
+    start_memory_tracing()
+    warm_up_font(font_path)
+
+
+def render_from_settings(
+    settings, font_path, text=None, binary_file=None, output_options=None, frequencies=None, mask_bytes=None
+):
+    """
+    generate_from_settings で作った画像をエンコードしたバイト列を返す。
+    output_options は {"image_format", "png_compress_level", "quality"}（省略時はPNG）。
+    """
+    output_options = output_options or {}
+    wordcloud = generate_from_settings(
+        settings, font_path, text=text, binary_file=binary_file, frequencies=frequencies, mask_bytes=mask_bytes
+    )
+    return render_wordcloud_to_bytes(
+        wordcloud,
+        output_options.get("image_format", "PNG"),
+        compress_level=output_options.get("png_compress_level", 6),
+        quality=output_options.get("quality", 90),
+    )
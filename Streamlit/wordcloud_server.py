@@ -0,0 +1,410 @@
+"""
+ワードクラウド生成のHTTPサービス（社内ツールから呼び出す用。外部サービス不要）。
+
+起動:
+    python Streamlit/wordcloud_server.py --port 8600
+
+エンドポイント:
+    POST /generate  本文はJSON
+        {"text": "...", "settings": {...last_settingsと同じ形式...},
+         "image_format": "PNG", "png_compress_level": 6, "quality": 90}
+        → 画像のバイト列（使ったシードは X-Wordcloud-Seed ヘッダーで返す）
+    GET /health     ワーカープールが動いているか
+    GET /metrics    リクエスト数・待ち行列・処理時間など（JSON）
+    GET /metrics/prometheus  上の値と段階ごとの処理時間（Prometheusのテキスト形式）
+
+生成はワーカープロセス（それぞれトークナイザとフォントを温めたもの）で行うので、
+同時に来たリクエストが1つのPythonスレッドで順番待ちになることはない。
+ワーカー数＋待ち行列の上限を超えたリクエストはすぐに503で断る。
+タイムアウト（504）を返しても、すでにワーカーに渡った生成は取り消せずに最後まで走り、
+終わるまで枠をふさぐ（/metrics の abandoned がその数）。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import secrets
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from instrumentation import configure_logging, prometheus_text, record_spans, trace
+from wordcloud_core import init_generation_worker, render_from_settings
+from wordcloud_settings import DEFAULT_FONT_PATH, IMAGE_FORMATS, OUTPUT_OPTION_RANGES, normalize_settings
+
+SERVER_HOST = os.getenv("WORDCLOUD_SERVER_HOST", "127.0.0.1")
+SERVER_PORT = int(os.getenv("WORDCLOUD_SERVER_PORT", "8600"))
+# 生成を行うワーカープロセスの数
+SERVER_WORKERS = int(os.getenv("WORDCLOUD_SERVER_WORKERS", str(os.cpu_count() or 1)))
+# ワーカーが全部ふさがっているときに待たせておけるリクエスト数（これを超えたら503）
+SERVER_QUEUE_DEPTH = int(os.getenv("WORDCLOUD_SERVER_QUEUE_DEPTH", "16"))
+# 1リクエストの待ち時間の上限（秒。待ち行列にいる時間も含む。超えたら504。504を返しても枠は生成が終わるまで空かない）
+SERVER_TIMEOUT = float(os.getenv("WORDCLOUD_SERVER_TIMEOUT", "60"))
+SERVER_MAX_BODY_BYTES = int(os.getenv("WORDCLOUD_SERVER_MAX_BODY_BYTES", str(16 * 1024 * 1024)))
+
+
+class RequestRejected(Exception):
+    """待ち行列がいっぱいで受け付けられないとき"""
+
+
+# =========================================================
+# ワーカープール（待ち行列の上限つき）
+# =========================================================
+def render_traced(settings, font_path, text, output_options):
+    """
+    ワーカープロセスで生成し、画像と各段階の計測結果を返す。
+    """
+    with trace() as spans:
+        data = render_from_settings(settings, font_path, text=text, output_options=output_options)
+    return data, [s.to_dict() for s in spans]
+
+
+class GenerationPool:
+    """
+    ワーカープロセスのプール。実行中＋待ち行列の数を workers + queue_depth までに抑える。
+    """
+
+    def __init__(self, font_path, workers, queue_depth):
+        self.font_path = font_path
+        self.workers = max(1, workers)
+        self.queue_depth = max(0, queue_depth)
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue_depth)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._abandoned = 0  # タイムアウトで応答済みだが、まだワーカーで動いている数
+        self._executor = self._new_executor()
+
+    def _new_executor(self):
+        # HTTPのスレッドが動いている中でforkしないよう、spawnでワーカーを起動する
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_generation_worker,
+            initargs=(self.font_path,),
+        )
+
+    def start(self):
+        """
+        ワーカーをすべて起動して初期化が終わるまで待つ（最初のリクエストで待たせない）。
+        """
+        futures = [self._executor.submit(os.getpid) for _ in range(self.workers)]
+        for future in futures:
+            future.result()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    @property
+    def abandoned(self):
+        return self._abandoned
+
+    def _release(self, _future):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def submit(self, settings, text, output_options):
+        """
+        生成を投入して (投入先のexecutor, future) を返す。result() にそのまま渡す。
+        """
+        if not self._slots.acquire(blocking=False):
+            raise RequestRejected()
+        with self._lock:
+            self._pending += 1
+        executor = self._executor
+        try:
+            future = executor.submit(render_traced, settings, self.font_path, text, output_options)
+        except BrokenProcessPool:
+            self._release(None)
+            self._replace_broken(executor)
+            raise
+        # 枠はタイムアウトで応答を返したときではなく、ワーカーの処理が終わったときに返す
+        future.add_done_callback(self._release)
+        return executor, future
+
+    def _forget_abandoned(self, _future):
+        with self._lock:
+            self._abandoned -= 1
+
+    def _replace_broken(self, broken):
+        with self._lock:
+            if self._executor is broken:
+                self._executor = self._new_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def result(self, submitted, timeout):
+        executor, future = submitted
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            # まだ待ち行列にいれば取り消す。ワーカーに渡ったもの（ProcessPoolExecutorが先に送っておく分も含む）は
+            # 取り消せずに最後まで走り、終わるまで枠をふさぐので、その数を数えておく
+            if not future.cancel():
+                with self._lock:
+                    self._abandoned += 1
+                future.add_done_callback(self._forget_abandoned)
+            raise
+        except BrokenProcessPool:
+            # 今のexecutorではなく投入先を渡す（別のリクエストが作り直した新しいプールを止めないように）
+            self._replace_broken(executor)
+            raise
+
+    def alive(self):
+        # ワーカーが全部ふさがっているときは、待ち行列に並ばずに「動いている」とみなす
+        if self._pending >= self.workers:
+            return True
+        try:
+            return self._executor.submit(os.getpid).result(timeout=5) > 0
+        except Exception:
+            return False
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# =========================================================
+# 計測値
+# =========================================================
+class ServerMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.counts = {
+            "requests": 0,
+            "succeeded": 0,
+            "rejected": 0,
+            "timed_out": 0,
+            "bad_request": 0,
+            "failed": 0,
+        }
+        self.latency_seconds_sum = 0.0
+        self.latency_seconds_max = 0.0
+
+    def incr(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def observe(self, seconds):
+        with self._lock:
+            self.latency_seconds_sum += seconds
+            self.latency_seconds_max = max(self.latency_seconds_max, seconds)
+
+    def prometheus_lines(self, pool):
+        snapshot = self.snapshot(pool)
+        lines = [
+            "# HELP wordcloud_server_requests_total Generation requests by result.",
+            "# TYPE wordcloud_server_requests_total counter",
+        ]
+        for name in ("succeeded", "rejected", "timed_out", "bad_request", "failed"):
+            lines.append(f'wordcloud_server_requests_total{{result="{name}"}} {snapshot[name]}')
+        lines += [
+            "# HELP wordcloud_server_pending Requests running or waiting in the queue.",
+            "# TYPE wordcloud_server_pending gauge",
+            f"wordcloud_server_pending {snapshot['pending']}",
+            "# HELP wordcloud_server_abandoned Timed-out requests still running in a worker (counted in pending).",
+            "# TYPE wordcloud_server_abandoned gauge",
+            f"wordcloud_server_abandoned {snapshot['abandoned']}",
+            "# HELP wordcloud_server_latency_seconds_sum Total latency of succeeded requests.",
+            "# TYPE wordcloud_server_latency_seconds_sum counter",
+            f"wordcloud_server_latency_seconds_sum {self.latency_seconds_sum:.6f}",
+        ]
+        return lines
+
+    def snapshot(self, pool):
+        with self._lock:
+            succeeded = self.counts["succeeded"]
+            return {
+                **self.counts,
+                "pending": pool.pending,
+                "abandoned": pool.abandoned,
+                "workers": pool.workers,
+                "queue_depth": pool.queue_depth,
+                "latency_seconds_avg": self.latency_seconds_sum / succeeded if succeeded else 0.0,
+                "latency_seconds_max": self.latency_seconds_max,
+                "uptime_seconds": time.time() - self.started_at,
+            }
+
+
+# =========================================================
+# HTTP
+# =========================================================
+class GenerationHandler(BaseHTTPRequestHandler):
+    server_version = "WordcloudServer/1.0"
+    protocol_version = "HTTP/1.1"
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, data, headers=None):
+        self._send(status, json.dumps(data, ensure_ascii=False).encode("utf-8"), headers=headers)
+
+    def do_GET(self):
+        pool = self.server.pool
+        if self.path == "/health":
+            if pool.alive():
+                self._send_json(200, {"status": "ok"})
+            else:
+                self._send_json(503, {"status": "unavailable"})
+        elif self.path == "/metrics":
+            self._send_json(200, self.server.metrics.snapshot(pool))
+        elif self.path == "/metrics/prometheus":
+            body = prometheus_text(self.server.metrics.prometheus_lines(pool)).encode("utf-8")
+            self._send(200, body, content_type="text/plain; version=0.0.4; charset=utf-8")
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/generate":
+            self._send_json(404, {"error": "not found"})
+            return
+
+        metrics = self.server.metrics
+        metrics.incr("requests")
+        started = time.perf_counter()
+
+        try:
+            request = self._read_request()
+        except (TypeError, ValueError) as e:
+            metrics.incr("bad_request")
+            self._send_json(400, {"error": str(e)})
+            return
+        if request is None:
+            metrics.incr("bad_request")
+            # 本文を読んでいないので接続は使い回さない
+            self.close_connection = True
+            self._send_json(413, {"error": "request body too large"})
+            return
+        settings, text, output_options = request
+
+        pool = self.server.pool
+        try:
+            submitted = pool.submit(settings, text, output_options)
+            data, spans = pool.result(submitted, self.server.request_timeout)
+        except RequestRejected:
+            metrics.incr("rejected")
+            self._send_json(503, {"error": "queue is full"}, headers={"Retry-After": "1"})
+            return
+        except FutureTimeoutError:
+            metrics.incr("timed_out")
+            self._send_json(504, {"error": "timed out"})
+            return
+        except ValueError as e:
+            # 単語が1つも残らなかった場合など
+            metrics.incr("bad_request")
+            self._send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            metrics.incr("failed")
+            self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+
+        record_spans(spans)
+        metrics.incr("succeeded")
+        metrics.observe(time.perf_counter() - started)
+        mime = IMAGE_FORMATS[output_options["image_format"]][2]
+        self._send(200, data, content_type=mime, headers={"X-Wordcloud-Seed": str(settings["seed"])})
+
+    def _read_request(self):
+        """
+        本文を読んで (settings, text, output_options) を返す。大きすぎるときは None。
+        """
+        raw_length = (self.headers.get("Content-Length") or "").strip()
+        # 負の値だと read(-1) が接続が閉じられるまで待ってしまうので、読む前に断る
+        if not (raw_length.isascii() and raw_length.isdigit()):
+            # 本文を読んでいないので接続は使い回さない
+            self.close_connection = True
+            raise ValueError("Content-Length must be a non-negative integer")
+        length = int(raw_length)
+        if length > SERVER_MAX_BODY_BYTES:
+            return None
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError as e:
+            raise ValueError(f"invalid JSON: {e}")
+        if not isinstance(body, dict):
+            raise ValueError("request body must be a JSON object")
+
+        text = body.get("text")
+        if not isinstance(text, str) or not text.strip():
+            raise ValueError("text is required")
+
+        raw_settings = body.get("settings")
+        if raw_settings is not None and not isinstance(raw_settings, dict):
+            raise ValueError("settings must be a JSON object")
+        # 数値は画面と同じ範囲に収める（巨大な画像などを作らせない）
+        settings = normalize_settings(raw_settings)
+        if settings["seed"] is None:
+            settings["seed"] = secrets.randbelow(2**31 - 1)
+
+        image_format = body.get("image_format", "PNG")
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"image_format must be one of {list(IMAGE_FORMATS)}")
+        output_options = {"image_format": image_format}
+        for key, default in (("png_compress_level", 6), ("quality", 90)):
+            low, high = OUTPUT_OPTION_RANGES[key]
+            value = body.get(key, default)
+            # True / 1.5 / "6" なども受け付けない
+            if not isinstance(value, int) or isinstance(value, bool) or not low <= value <= high:
+                raise ValueError(f"{key} must be an integer between {low} and {high}")
+            output_options[key] = value
+        return settings, text, output_options
+
+    def log_message(self, format, *args):
+        sys.stderr.write(f"[{self.log_date_time_string()}] {self.address_string()} {format % args}\n")
+
+
+class GenerationServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, pool, request_timeout):
+        super().__init__(address, GenerationHandler)
+        self.pool = pool
+        self.metrics = ServerMetrics()
+        self.request_timeout = request_timeout
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ワードクラウド生成のHTTPサービス")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--font", default=DEFAULT_FONT_PATH, help="フォントファイルのパス")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="ワーカープロセス数")
+    parser.add_argument("--queue-depth", type=int, default=SERVER_QUEUE_DEPTH, help="待ち行列の上限")
+    parser.add_argument("--timeout", type=float, default=SERVER_TIMEOUT, help="1リクエストのタイムアウト（秒）")
+    args = parser.parse_args(argv)
+    configure_logging()
+
+    if not os.path.exists(args.font):
+        print(f"フォントが見つかりません: {args.font}", file=sys.stderr)
+        return 2
+
+    pool = GenerationPool(args.font, args.workers, args.queue_depth)
+    pool.start()
+    server = GenerationServer((args.host, args.port), pool, args.timeout)
+    print(
+        f"listening on http://{args.host}:{args.port} "
+        f"(workers={pool.workers}, queue_depth={pool.queue_depth}, timeout={args.timeout}s)",
+        file=sys.stderr,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+"""
+画面の設定と出力形式の定義（重いライブラリを import しない）。
+
+Streamlitアプリの最初の表示で読み込むので、matplotlib / wordcloud / janome などは
+ここでは import しないこと（生成の本体は wordcloud_core.py）。
+"""
+import os
+import json
+import math
+import zlib
+import base64
+from datetime import datetime
+
+
+# =========================================================
+# 設定（Streamlitの last_settings と同じ形式）
+# =========================================================
+# 画面の初期値と同じ
+DEFAULT_SETTINGS = {
+    "priority_nouns_input": "北海道文化放送,中道改革連合,日本維新の会,国民民主党,れいわ新選組,参政党,日本保守党,チームみらい",
+    "exclude_input": "https,的, こと, もの, それ, これ, ため, よう, そこ, どこ, とき, あと, みたい, ような",
+    "use_default_stopwords": False,
+    "normalize_text": False,
+    "selected_pos": ["名詞"],
+    "max_words": 20,
+    "min_font_size": 10,
+    "width": 800,
+    "height": 600,
+    "is_horizontal_only": True,
+    "background_color": "#f4f5f7",
+    "check_contrast": True,
+    "colormap": "viridis",
+    "contour_width": 0,
+    "contour_color": "#000000",
+    "seed": None,
+}
+
+
+# 数値の設定の範囲（画面のスライダー・入力欄と同じ。外部から受け取った値はこの範囲に収める）
+SETTING_RANGES = {
+    "max_words": (5, 200),
+    "min_font_size": (1, 200),
+    "width": (100, 4000),
+    "height": (100, 4000),
+    "contour_width": (0, 50),
+}
+# 文字列の設定
+STRING_SETTING_KEYS = ("priority_nouns_input", "exclude_input", "background_color", "colormap", "contour_color")
+
+
+def split_comma_list(value):
+    """
+    カンマ区切りの入力をリストにする（前後の空白と空要素は除く）。
+    """
+    return [w.strip() for w in (value or "").split(",") if w.strip()]
+
+
+def normalize_settings(settings):
+    """
+    保存された設定に初期値を補い、型をそろえる（足りない・壊れている値は初期値にする）。
+    """
+    merged = dict(DEFAULT_SETTINGS)
+    merged.update({k: v for k, v in (settings or {}).items() if k in DEFAULT_SETTINGS})
+
+    def _to_int(x, default):
+        try:
+            return int(x)
+        except Exception:
+            return default
+
+    for key, (low, high) in SETTING_RANGES.items():
+        merged[key] = min(max(_to_int(merged[key], DEFAULT_SETTINGS[key]), low), high)
+    for key in ("is_horizontal_only", "check_contrast", "use_default_stopwords", "normalize_text"):
+        merged[key] = bool(merged[key])
+    for key in STRING_SETTING_KEYS:
+        if not isinstance(merged[key], str):
+            merged[key] = DEFAULT_SETTINGS[key]
+    if merged["seed"] is not None:
+        merged["seed"] = _to_int(merged["seed"], None)
+    if not isinstance(merged["selected_pos"], list):
+        merged["selected_pos"] = list(DEFAULT_SETTINGS["selected_pos"])
+    merged["selected_pos"] = [pos for pos in merged["selected_pos"] if isinstance(pos, str)]
+    return merged
+
+
+# 配置に影響しない（色だけの）設定
+COLOR_SETTING_KEYS = ("background_color", "colormap", "check_contrast", "contour_width", "contour_color")
+
+
+def load_settings(path):
+    """
+    設定のJSONファイル（設定そのもの、または {"settings": {...}} の形）を読む。path が空なら {}。
+    """
+    if not path:
+        return {}
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict) and isinstance(data.get("settings"), dict):
+        data = data["settings"]
+    if not isinstance(data, dict):
+        raise ValueError(f"設定ファイルの形式が正しくありません: {path}")
+    return data
+
+
+# =========================================================
+# コマンドライン・サーバー・ベンチマーク共通
+# =========================================================
+DEFAULT_FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "GenSekiGothic2JP-B.otf")
+# 入力として読むテキストファイルの拡張子
+INPUT_EXTENSIONS = (".txt", ".csv")
+
+
+# =========================================================
+# 出力形式（表示名 → PILの形式, 拡張子, MIMEタイプ）
+# =========================================================
+IMAGE_FORMATS = {
+    "PNG": ("PNG", "png", "image/png"),
+    "WebP": ("WEBP", "webp", "image/webp"),
+    "JPEG": ("JPEG", "jpg", "image/jpeg"),
+}
+# エンコーダの設定の範囲（画面と同じ）
+OUTPUT_OPTION_RANGES = {
+    "png_compress_level": (0, 9),
+    "quality": (1, 100),
+}
+
+
+# 幅・高さのどちらかがこれを超える場合、プレビューモードでは縮小して配置する
+PREVIEW_MAX_SIDE = int(os.getenv("WORDCLOUD_PREVIEW_MAX_SIDE", "1000"))
+
+
+def preview_scale_for(width, height, max_side=PREVIEW_MAX_SIDE):
+    """
+    プレビュー用に配置を計算するときの縮小倍率（整数）。max_side以下なら1（縮小しない）。
+    """
+    return max(1, math.ceil(max(width, height) / max_side))
+
+
+# =========================================================
+# 保存履歴（cookie）の圧縮形式
+# =========================================================
+# "2." + base64url(zlib(JSON))。JSONは1件を [id, 保存日時(UNIX秒), 名前, 設定] のリストで表し、
+# 設定は DEFAULT_SETTINGS と異なる値だけを短いキーで持つ。
+# DEFAULT_SETTINGS の値を変えると保存済みの設定の意味も変わるので、そのときは形式のバージョンを上げること
+# （項目を追加するだけなら、古いデータはその項目が初期値のものとして読める）。
+HISTORY_FORMAT_VERSION = "2"
+
+SETTING_SHORT_KEYS = {
+    "priority_nouns_input": "p",
+    "exclude_input": "x",
+    "use_default_stopwords": "d",
+    "normalize_text": "k",
+    "selected_pos": "s",
+    "max_words": "n",
+    "min_font_size": "f",
+    "width": "w",
+    "height": "h",
+    "is_horizontal_only": "o",
+    "background_color": "b",
+    "check_contrast": "c",
+    "colormap": "m",
+    "contour_width": "cw",
+    "contour_color": "cc",
+    "seed": "r",
+}
+SETTING_LONG_KEYS = {v: k for k, v in SETTING_SHORT_KEYS.items()}
+
+
+def compact_settings(settings):
+    """
+    設定を初期値と異なる値だけの短いキーの辞書にする。
+    """
+    settings = normalize_settings(settings)
+    return {
+        SETTING_SHORT_KEYS[k]: v for k, v in settings.items() if v != DEFAULT_SETTINGS[k]
+    }
+
+
+def expand_settings(compact):
+    return normalize_settings({SETTING_LONG_KEYS[k]: v for k, v in compact.items() if k in SETTING_LONG_KEYS})
+
+
+def encode_history(history):
+    """
+    保存履歴（{"id", "created_at", "name", "settings"} のリスト）を cookie 用の文字列にする。
+    """
+    rows = []
+    for item in history:
+        try:
+            created_at = int(datetime.fromisoformat(item.get("created_at", "")).timestamp())
+        except (TypeError, ValueError):
+            created_at = 0
+        rows.append([item.get("id", ""), created_at, item.get("name", ""), compact_settings(item.get("settings"))])
+    raw = json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    encoded = base64.urlsafe_b64encode(zlib.compress(raw, 9)).decode("ascii").rstrip("=")
+    return f"{HISTORY_FORMAT_VERSION}.{encoded}"
+
+
+def decode_history(value, tz=None):
+    """
+    encode_history() の逆。保存日時は tz のISO形式の文字列に戻す。壊れていれば空のリスト。
+    """
+    version, _, encoded = (value or "").partition(".")
+    if version != HISTORY_FORMAT_VERSION:
+        return []
+    try:
+        raw = zlib.decompress(base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)))
+        rows = json.loads(raw)
+        return [
+            {
+                "id": item_id,
+                "created_at": datetime.fromtimestamp(created_at, tz).isoformat(timespec="seconds") if created_at else "",
+                "name": name,
+                "settings": expand_settings(compact),
+            }
+            for item_id, created_at, name, compact in rows
+        ]
+    except Exception:
+        return []